@@ -0,0 +1,117 @@
+import struct
+
+# Binary framing of hub commands, the bridge side of Framing.py on the hub.
+# Command: START opcode seq length [args] checksum
+#   args are ARG_INT + int16 little endian, or ARG_STR + length + utf-8
+# Reply:   START status seq length [utf-8 payload] checksum
+# The checksum is the sum of all bytes after START, modulo 256.
+
+START = 0xA5
+HEADER_SIZE = 4
+
+ARG_INT = 0x01
+ARG_STR = 0x02
+
+STATUS_OK = 0
+STATUS_LINEDETECTED = 1
+STATUS_ERROR = 2
+
+OPCODES = {
+    "drive": 1,
+    "turn": 2,
+    "display": 3,
+    "searchandgrab": 4,
+    "releasegrabber": 5,
+    "dance": 6,
+    "setting": 7,
+    "sensors": 8,
+    "version": 9,
+    "script": 10,
+    "search": 11,
+}
+
+MAX_SEQ = 255
+
+class FramingException(Exception):
+    pass
+
+def can_encode(action):
+    return action in OPCODES
+
+def encode_arg(param):
+    try:
+        value = int(param)
+        if -0x8000 <= value < 0x8000 and str(value) == param:
+            return struct.pack("<Bh", ARG_INT, value)
+    except ValueError:
+        pass
+    data = param.encode("utf-8")
+    if len(data) > 255:
+        raise FramingException(f"Parameter too long for a frame: {param[:20]}...")
+    return struct.pack("<BB", ARG_STR, len(data)) + data
+
+def encode_command(action, seq, parameters):
+    args = b""
+    if parameters != "":
+        args = b"".join(encode_arg(p) for p in parameters.split("|"))
+    if len(args) > 255:
+        raise FramingException(f"Arguments too long for a frame: {len(args)} bytes")
+    body = bytes([OPCODES[action], seq, len(args)]) + args
+    return bytes([START]) + body + bytes([sum(body) & 0xFF])
+
+def is_frame(data):
+    return len(data) > 0 and data[0] == START
+
+# Returns (status, seq, payload) for a complete reply frame.
+def decode_reply(data):
+    if len(data) < HEADER_SIZE + 1 or data[0] != START:
+        raise FramingException("Not a reply frame")
+    length = data[3]
+    end = HEADER_SIZE + length
+    if len(data) != end + 1:
+        raise FramingException(f"Reply frame has {len(data)} bytes, expected {end + 1}")
+    if sum(data[1:end]) & 0xFF != data[end]:
+        raise FramingException("Reply frame checksum mismatch")
+    return data[1], data[2], str(data[HEADER_SIZE:end], encoding='utf-8')
+
+# Turns the stream of BLE notifications back into messages. A notification
+# may hold part of a message or several messages, so bytes are buffered and
+# split: binary frames by their length, text replies on the newline that
+# protocol 4 hubs end them with. Until a newline has been seen the hub is
+# assumed to be older, and every notification is taken as one message.
+class ResponseFramer:
+    def __init__(self, dispatch, delimiter=b"\n"):
+        self.dispatch = dispatch
+        self.delimiter = delimiter
+        self.buffer = bytearray()
+        self.delimited = False
+
+    def reset(self):
+        self.buffer.clear()
+        self.delimited = False
+
+    def feed(self, data):
+        self.buffer += data
+        while self.buffer:
+            if self.buffer[0] == START:
+                if len(self.buffer) < HEADER_SIZE:
+                    return
+                size = HEADER_SIZE + self.buffer[3] + 1
+                if len(self.buffer) < size:
+                    return
+                message = bytes(self.buffer[:size])
+                del self.buffer[:size]
+                self.dispatch(message)
+            else:
+                end = self.buffer.find(self.delimiter)
+                if end < 0:
+                    if not self.delimited:
+                        message = bytes(self.buffer)
+                        self.buffer.clear()
+                        self.dispatch(message)
+                    return
+                self.delimited = True
+                message = bytes(self.buffer[:end]).rstrip(b"\r")
+                del self.buffer[:end + len(self.delimiter)]
+                if message:
+                    self.dispatch(message)
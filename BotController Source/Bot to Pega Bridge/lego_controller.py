@@ -1,83 +1,446 @@
 import asyncio
-from bleak import BleakScanner, BleakClient
+import collections
+import json
+import os
+import random
 import time
+from bleak import BleakScanner, BleakClient
+import hub_framing
 
 UART_SERVICE_UUID = "6E400001-B5A3-F393-E0A9-E50E24DCCA9E"
 UART_RX_CHAR_UUID = "6E400002-B5A3-F393-E0A9-E50E24DCCA9E"
 UART_TX_CHAR_UUID = "6E400003-B5A3-F393-E0A9-E50E24DCCA9E"
 
 class LegoControllerException(Exception):
-    def __init__(self, type):
+    def __init__(self, type, steps=None, message=None):
         self.type = type
+        # Results of the steps of a script that ran before the event.
+        self.steps = steps
+        # Why the hub rejected an instruction ("error" events).
+        self.message = message
 
     def getData(self):
-        return {"type": self.type}
+        data = {"type": self.type}
+        if self.steps is not None:
+            data["steps"] = self.steps
+        if self.message is not None:
+            data["message"] = self.message
+        return data
+
+# Protocol 2 tags every command with a sequence number that the hub echoes:
+# #[seq]:[action]>[params]  ->  #[seq]:OK>[response] or #[seq]:linedetected
+# Protocol 1 hubs answer untagged and only one command can be in flight.
+# Protocol 3 hubs also accept the binary frames of hub_framing.
+# Protocol 4 hubs end text replies with a newline.
+# Protocol 5 hubs run a script of steps in one command:
+# script>[action],[param],...|[action],[param],...  ->  OK>[result];[result];...
+# Hubs answer instructions they cannot run with error>[message], which is
+# reported as an "error" event.
+PROTOCOL_VERSION = 5
+SCRIPT_PROTOCOL = 5
+SCRIPT_ARGS = ","
+SCRIPT_RESULTS = ";"
+MAX_SEQ = 9999
+RECONNECT_FIRST_DELAY = 0.5
+# While reconnecting, only every RESCAN_EVERY-th attempt falls back to a scan
+# when the cached address does not answer.
+RESCAN_EVERY = 4
+SCAN_TIMEOUT = 10.0
+# ATT header bytes in every write; the payload per write is MTU - 3.
+ATT_HEADER = 3
+# Bytes written without response before one write waits for the hub's
+# acknowledgement, so the hub's receive buffer cannot overflow.
+WRITE_WINDOW = 512
+
+# Last known Bluetooth address per hub name, so connecting skips the scan.
+def load_addresses(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def store_address(path, name, address):
+    addresses = load_addresses(path)
+    if addresses.get(name) == address:
+        return
+    addresses[name] = address
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(addresses, f, indent=2)
+    os.replace(tmp, path)
+
+class PendingCommand:
+    def __init__(self, future):
+        self.future = future
+        self.response = ""
+        self.event = ""
+        self.receivedAt = None
 
 class LegoController:
-    def __init__(self, name, onReady):
+    def __init__(self, name, onReady, timeout=None, binary=False, addressCache=None, reconnectMaxDelay=10, metrics=None):
         self.name = name
         self.ready = False
         self.onReady = onReady
         self.processing = False
         self.response = ""
+        self.event = ""
+        self.connected = False
+        # Seconds a command may take on the hub before execute() gives up.
+        self.timeout = timeout
+        # Commands waiting for their reply, by sequence number (None for the
+        # single untagged protocol 1 command). handle_response resolves them.
+        self.pending = {}
+        self.seq = 0
+        self.protocol = 1
+        # Use binary frames when the hub supports them.
+        self.binary = binary
+        self.serial = asyncio.Lock()
+        # Keeps the chunks of concurrent commands from interleaving.
+        self.writeLock = asyncio.Lock()
+        self.unacknowledged = 0
+        self.hello = None
+        self.skipOk = False
+        self.framer = hub_framing.ResponseFramer(self.handle_message)
+        # File with the last known hub addresses (None to always scan).
+        self.addressCache = addressCache
+        self.reconnectMaxDelay = reconnectMaxDelay
+        self.client = None
+        self.linked = asyncio.Event()
+        self.negotiated = False
+        # The reconnect and a Hello of a restarted hub program both negotiate;
+        # they take turns, so the later one sets the protocol of the program
+        # that is running now.
+        self.negotiation = asyncio.Lock()
+        self.closing = False
+        self.reconnectTask = None
+        self.disconnectedAt = None
+        # Time-to-reconnect in seconds of the most recent reconnects.
+        self.reconnects = 0
+        self.reconnectTimes = collections.deque(maxlen=50)
+        # Optional metrics.Metrics for the phase timings of every command.
+        self.metrics = metrics
+        self.receivedAt = None
 
     async def connect(self):
-        device = await BleakScanner.find_device_by_name(self.name)
-        self.client = BleakClient(device, disconnected_callback=self.handle_disconnect)
-        print(self.client)
-        await self.client.connect()
-        await self.client.start_notify(UART_TX_CHAR_UUID, self.handle_response)
-        self.nus = self.client.services.get_service(UART_SERVICE_UUID)
-        self.rx_char = self.nus.get_characteristic(UART_RX_CHAR_UUID)
+        self.loop = asyncio.get_running_loop()
+        self.hello = asyncio.Event()
+        await self.link()
         self.ready = True
         self.onReady()
-        self.event = ""
-        self.connected = False
         print("Start the program on the hub now with the button.")
-        while self.connected == False:
-            await asyncio.sleep(0.5)
-        print("Connection established.")
+        await self.hello.wait()
+        await self.negotiate()
+        self.negotiated = True
+        print(f"Connection established (protocol {self.protocol}).")
+
+    async def link(self, scan=True):
+        self.framer.reset()
+        self.client = None
+        address = None
+        if self.addressCache is not None:
+            address = load_addresses(self.addressCache).get(self.name)
+        if address is not None:
+            try:
+                await self.open(address)
+            except Exception as e:
+                print(f"Cached address {address} failed ({e}), scanning for {self.name}.")
+                self.client = None
+        if self.client is None:
+            if address is not None and not scan:
+                raise LegoControllerException("unreachable")
+            device = await BleakScanner.find_device_by_name(self.name, timeout=SCAN_TIMEOUT)
+            if device is None:
+                raise LegoControllerException("notfound")
+            await self.open(device)
+        if self.addressCache is not None:
+            store_address(self.addressCache, self.name, self.client.address)
+        self.linked.set()
+
+    async def open(self, device):
+        client = BleakClient(device, disconnected_callback=self.handle_disconnect)
+        print(client)
+        await client.connect()
+        self.client = client
+        await client.start_notify(UART_TX_CHAR_UUID, self.handle_response)
+        self.nus = client.services.get_service(UART_SERVICE_UUID)
+        self.rx_char = self.nus.get_characteristic(UART_RX_CHAR_UUID)
+        self.withoutResponse = "write-without-response" in self.rx_char.properties
+        if self.withoutResponse:
+            self.chunkSize = self.rx_char.max_write_without_response_size
+        else:
+            self.chunkSize = client.mtu_size - ATT_HEADER
+        self.unacknowledged = 0
+        print(f"MTU {client.mtu_size}, {self.chunkSize} bytes per write, write without response: {self.withoutResponse}")
+
+    async def disconnect(self):
+        self.closing = True
+        if self.reconnectTask is not None:
+            self.reconnectTask.cancel()
+        if self.client is not None:
+            await self.client.disconnect()
+
+    async def negotiate(self):
+        # A protocol 1 hub answers the tagged version query untagged, so the
+        # query simply times out. Untagged commands wait meanwhile, or they
+        # would take that answer for their own.
+        async with self.negotiation:
+            if self.protocol < 2:
+                async with self.serial:
+                    await self.query_version()
+            else:
+                await self.query_version()
 
-    def handle_disconnect(self):
+    async def query_version(self):
+        try:
+            version = await self.run_command(self.next_seq(), "version", "", 2)
+            self.protocol = min(int(version), PROTOCOL_VERSION)
+        except (LegoControllerException, ValueError):
+            self.protocol = 1
+
+    def handle_disconnect(self, client=None):
+        if client is not None and client is not self.client:
+            return
         print("Hub was disconnected.")
+        self.linked.clear()
+        self.disconnectedAt = time.monotonic()
+        # Whatever was in flight may or may not have completed on the hub;
+        # it is failed, so the bridge reports it instead of waiting forever.
+        for command in self.pending.values():
+            if not command.future.done():
+                command.event = "disconnected"
+                command.future.set_result(True)
+        self.pending.clear()
+        self.processing = False
+        self.skipOk = False
+        if not self.closing and (self.reconnectTask is None or self.reconnectTask.done()):
+            self.reconnectTask = self.loop.create_task(self.reconnect())
+
+    async def reconnect(self):
+        delay = RECONNECT_FIRST_DELAY
+        attempt = 0
+        while not self.closing:
+            attempt += 1
+            try:
+                await self.link(scan=attempt % RESCAN_EVERY == 0)
+                break
+            except Exception as e:
+                print(f"Reconnecting to {self.name} failed: {e}")
+                await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+                delay = min(delay * 2, self.reconnectMaxDelay)
+        if self.closing:
+            return
+        elapsed = time.monotonic() - self.disconnectedAt
+        self.reconnects += 1
+        self.reconnectTimes.append(elapsed)
+        if self.metrics is not None:
+            self.metrics.count("reconnects", self.name)
+            self.metrics.observe_reconnect(self.name, elapsed)
+        print(f"Reconnected to {self.name} in {elapsed:.2f} s.")
+        # The hub program normally kept running; if it was restarted, its
+        # Hello triggers another negotiation.
+        await self.negotiate()
 
     def handle_response(self, _, data: bytearray):
+        self.receivedAt = time.monotonic()
+        self.framer.feed(data)
+
+    def handle_message(self, data):
+        if hub_framing.is_frame(data):
+            self.handle_frame(data)
+            return
         response = str(data, encoding='utf-8')
         print("Received:", response)
-        if response.startswith("OK"):
-            self.response = response[3:]
-            self.processing = False
-        elif response == "linedetected":
-            self.processing = False
-            self.event = "collision"
-        elif response == "Hello":
+        seq = None
+        if response.startswith("#"):
+            tag, _, response = response[1:].partition(":")
+            try:
+                seq = int(tag)
+            except ValueError:
+                print("Ignoring malformed reply:", tag)
+                return
+        if response == "Hello":
             self.connected = True
+            if self.hello is not None:
+                self.hello.set()
+            if self.negotiated:
+                self.loop.create_task(self.negotiate())
+        elif seq is None and response.startswith("OK") and self.skipOk:
+            # Trailing OK of a command that was already completed by
+            # "linedetected"; it must not complete the next command.
+            self.skipOk = False
+        elif response.startswith("OK"):
+            self.complete(seq, response[3:], "")
+        elif response.startswith("error>"):
+            self.complete(seq, response[6:], "error")
+        elif response == "linedetected":
+            # Tagged commands drop out of the table here, so their trailing
+            # OK is discarded as stale.
+            self.skipOk = seq is None
+            self.complete(seq, "", "collision")
+
+    def handle_frame(self, data):
+        try:
+            status, seq, payload = hub_framing.decode_reply(data)
+        except hub_framing.FramingException as e:
+            print("Ignoring reply frame:", e)
+            return
+        print("Received frame:", status, seq, payload)
+        if status == hub_framing.STATUS_OK:
+            self.complete(seq, payload, "")
+        elif status == hub_framing.STATUS_LINEDETECTED:
+            self.complete(seq, "", "collision")
+        else:
+            print("Hub rejected frame:", payload)
+            self.complete(seq, payload, "error")
+
+    def uses_frames(self):
+        return self.binary and self.protocol >= 3
+
+    def complete(self, seq, response, event):
+        command = self.pending.pop(seq, None)
+        if command is None or command.future.done():
+            print(f"Discarding stale reply for command {seq}")
+            return
+        command.response = response
+        command.event = event
+        command.receivedAt = self.receivedAt
+        command.future.set_result(True)
+        self.processing = len(self.pending) > 0
+
+    def next_seq(self):
+        maxSeq = hub_framing.MAX_SEQ if self.uses_frames() else MAX_SEQ
+        self.seq = self.seq % maxSeq + 1
+        return self.seq
 
     async def send(self, data):
         print(data)
         data = data + "\r"
-        await self.client.write_gatt_char(self.rx_char, data.encode(encoding = 'UTF-8'))
-    
-    async def wait(self):
-        while self.processing:
-            await asyncio.sleep(0.5)
+        await self.write(data.encode(encoding = 'UTF-8'))
 
-    async def execute(self, action, parameters):
+    async def send_frame(self, frame):
+        print(frame.hex())
+        await self.write(frame)
+
+    # Splits data into writes that fit the negotiated MTU. Writes go without
+    # response where the hub allows it; after every WRITE_WINDOW bytes one
+    # write waits for the acknowledgement as a simple form of flow control.
+    async def write(self, data):
+        async with self.writeLock:
+            for start in range(0, len(data), self.chunkSize):
+                chunk = data[start:start + self.chunkSize]
+                response = not self.withoutResponse
+                if not response and self.unacknowledged + len(chunk) > WRITE_WINDOW:
+                    response = True
+                await self.client.write_gatt_char(self.rx_char, chunk, response=response)
+                self.unacknowledged = 0 if response else self.unacknowledged + len(chunk)
+
+    async def run_command(self, seq, action, parameters, timeout):
+        command = PendingCommand(asyncio.get_running_loop().create_future())
+        self.pending[seq] = command
+        self.processing = True
+        try:
+            if not self.linked.is_set():
+                await asyncio.wait_for(self.linked.wait(), timeout)
+            started = time.monotonic()
+            frame = None
+            if seq is not None and self.uses_frames() and hub_framing.can_encode(action):
+                try:
+                    frame = hub_framing.encode_command(action, seq, parameters)
+                except hub_framing.FramingException as e:
+                    # The hub takes text commands next to frames.
+                    print(f"Sending {action} as text: {e}")
+            try:
+                if frame is not None:
+                    await self.send_frame(frame)
+                else:
+                    prefix = "" if seq is None else f"#{seq}:"
+                    await self.send(prefix + action + ">" + parameters)
+            except Exception as e:
+                print(f"Sending to {self.name} failed: {e}")
+                raise LegoControllerException("disconnected")
+            sent = time.monotonic()
+            await asyncio.wait_for(command.future, timeout)
+            self.record_timings(started, sent, command.receivedAt)
+        except asyncio.TimeoutError:
+            raise LegoControllerException("timeout" if self.linked.is_set() else "disconnected")
+        finally:
+            self.pending.pop(seq, None)
+            self.processing = len(self.pending) > 0
+        if command.event == "error":
+            self.event = command.event
+            raise LegoControllerException(command.event, message=command.response)
+        if command.event != "":
+            self.event = command.event
+            raise LegoControllerException(command.event)
+        return command.response
+
+    def record_timings(self, started, sent, received):
+        if self.metrics is None or received is None:
+            return
+        self.metrics.observe("ble_send", self.name, sent - started)
+        self.metrics.observe("hub_execute", self.name, max(received - sent, 0))
+        self.metrics.observe("notification", self.name, time.monotonic() - received)
+
+    async def execute(self, action, parameters, timeout=None):
+        # With protocol 2 several commands may be in flight, e.g. a sensor
+        # query next to a long drive; the hub runs motions in order.
         self.event = ""
         self.response = ""
         action = action.lower()
-        self.processing = True
-        await self.send(action+">"+parameters)
-        await self.wait()
-        if self.event != "":
-            raise LegoControllerException(self.event)
+        if timeout is None:
+            timeout = self.timeout
+        if action == "script":
+            response = await self.run_script(parameters, timeout)
+        else:
+            response = await self.run_one(action, parameters, timeout)
+        self.response = response
+        return response
+
+    async def run_one(self, action, parameters, timeout):
+        if self.protocol >= 2:
+            return await self.run_command(self.next_seq(), action, parameters, timeout)
+        async with self.serial:
+            return await self.run_command(None, action, parameters, timeout)
+
+    # Runs the steps of a script on the hub in one round trip; older hubs get
+    # the steps one by one. Either way the result lists every step that ran
+    # and a collision ends the script with a "collision" event.
+    async def run_script(self, parameters, timeout):
+        steps = [step for step in parameters.split("|") if step != ""]
+        if self.protocol >= SCRIPT_PROTOCOL:
+            if timeout is not None:
+                timeout = timeout * max(len(steps), 1)
+            results = (await self.run_one("script", "|".join(steps), timeout)).split(SCRIPT_RESULTS)
+        else:
+            results = []
+            for step in steps:
+                action, _, stepParameters = step.partition(SCRIPT_ARGS)
+                try:
+                    response = await self.run_one(action.lower(), stepParameters.replace(SCRIPT_ARGS, "|"), timeout)
+                except LegoControllerException as e:
+                    if e.type == "error":
+                        results.append("error:" + e.message)
+                        break
+                    if e.type != "collision":
+                        raise LegoControllerException(e.type, results)
+                    results.append("linedetected")
+                    break
+                results.append(response if response != "" else "ok")
+        if results and results[-1] == "linedetected":
+            self.event = "collision"
+            raise LegoControllerException("collision", results)
+        if results and results[-1].startswith("error:"):
+            self.event = "error"
+            raise LegoControllerException("error", results[:-1], results[-1][6:])
+        return SCRIPT_RESULTS.join(results)
     
 async def main():
     def callBack():
         print("Ready")
     controller = LegoController("Pega One", callBack)
     await controller.connect()
-    time.sleep(5)
+    await asyncio.sleep(5)
     await controller.execute("drive","5")
     print(controller.event)
     #controller.wait()
@@ -87,7 +450,7 @@ async def main():
     await controller.execute("turn","90")
     print(controller.event)
     #controller.wait()
-    time.sleep(5)
+    await asyncio.sleep(5)
 
 
 if __name__ == '__main__':
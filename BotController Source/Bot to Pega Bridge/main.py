@@ -1,72 +1,248 @@
 import asyncio
-import requests
-from requests.auth import HTTPBasicAuth
-import json
+import collections
 import time
 import yaml
 from lego_controller import LegoController
 from lego_controller import LegoControllerException
+from metrics import Metrics
+from outbox import Outbox
+from pega_client import PegaClient
+from pega_client import PegaClientException
+from poll_scheduler import PollScheduler
 
 setting = {}
 with open("settings.yaml", "r") as yamlfile:
     settings = yaml.load(yamlfile, Loader=yaml.FullLoader)
 
 robot_id = settings['robotId']
+# One bridge process can drive several hubs; 'robots' overrides 'robotId'.
+robot_ids = settings.get('robots') or [robot_id]
 
 baseUrl = settings['baseUrl']
 requestUrl = "robot/"+robot_id+"/instructions/next"
-basicAuth = HTTPBasicAuth(settings['userName'], settings['password'])
-
-def fetch_instructions(robot_id):
-    url = f"{baseUrl}robot/{robot_id}/instructions/next"
-    response = requests.get(url, auth=basicAuth)
-    if response.status_code == 200:
-        return response.json()
-    elif response.status_code == 204:
-        return None
+# All robots share the client's connection pools (polls and results), sized so
+# that every robot can have a poll and a result call open at the same time.
+client = PegaClient(baseUrl, settings['userName'], settings['password'],
+                    timeout=settings.get('httpTimeout', 10),
+                    retries=settings.get('httpRetries', 3),
+                    poolSize=max(4, 2 * len(robot_ids)))
+# Scanning and connecting are done one hub at a time on the shared adapter.
+connectLock = None
+# Phase timings and counters, served on metricsPort.
+metrics = Metrics()
+# Results wait here until Pega has them, across outages and restarts.
+outbox = Outbox(settings.get('outbox'))
+
+async def execute_instruction(robot_id, instruction, lego, fetchedAt):
+    metrics.observe("queue_wait", robot_id, time.monotonic() - fetchedAt)
+    metrics.count("instructions", robot_id)
+    try:
+        await lego.execute(instruction['Action'], instruction['Data'])
+    except LegoControllerException as e:
+        if e.type == "collision":
+            metrics.count("collisions", robot_id)
+        else:
+            metrics.count("hub_events", robot_id, type=e.type)
+        raise
+
+async def report_result(robot_id, kind, uid, data):
+    started = time.monotonic()
+    try:
+        if kind == "event":
+            await client.send_event(robot_id, uid, data)
+        else:
+            await client.update_instruction(robot_id, uid, data)
+    except Exception:
+        metrics.count("http_errors", robot_id, call=kind)
+        raise
+    metrics.observe("update", robot_id, time.monotonic() - started)
+
+def is_valid_instruction(instruction):
+    if not isinstance(instruction, dict):
+        return False
+    for key in ('UID', 'Action', 'Data'):
+        if key not in instruction:
+            print(f"Ignoring instruction without {key}: {instruction}")
+            return False
+    return True
+
+# An instruction that was executed before (its result got lost on the way to
+# Pega) is answered with the stored result instead of moving the robot again.
+async def replay_result(robot_id, instruction):
+    if not await outbox.replay(robot_id, instruction['UID']):
+        return False
+    print(f"Instruction {instruction['UID']} was already executed, sending its result again")
+    metrics.count("replays", robot_id)
+    return True
+
+# Uploads the outbox of one robot in order. A result Pega cannot take now
+# is retried with backoff and holds back the ones behind it; a result Pega
+# rejects (e.g. an unknown instruction) is dropped.
+async def upload_results(robot_id):
+    retry = create_scheduler()
+    while True:
+        batch = await outbox.next_batch(robot_id)
+        sent = []
+        failed = False
+        for id, uid, kind, data in batch:
+            try:
+                await report_result(robot_id, kind, uid, data)
+            except Exception as e:
+                if not isinstance(e, PegaClientException) or not e.isPermanent():
+                    print(f"Error reporting instruction {uid}, will retry: {e}")
+                    failed = True
+                    break
+                print(f"Pega rejected the result of instruction {uid}: {e.getData()}")
+            sent.append(id)
+        await outbox.mark_sent(robot_id, sent)
+        if failed:
+            retry.got_error()
+            await asyncio.sleep(retry.next_delay())
+        else:
+            retry.got_instruction()
+
+def create_scheduler():
+    return PollScheduler(minDelay=settings.get('pollMinDelay', 0.1),
+                         maxDelay=settings.get('pollMaxDelay', 5.0),
+                         longPoll=settings.get('longPoll', 0))
+
+# Returns the instruction (or None) and when it arrived.
+async def poll_instruction(robot_id, scheduler):
+    await asyncio.sleep(scheduler.next_delay())
+    scheduler.poll_started()
+    started = time.monotonic()
+    try:
+        instruction = await client.fetch_instructions(robot_id, wait=scheduler.long_poll_wait())
+    except Exception as e:
+        print(f"Error fetching instruction: {e}")
+        metrics.count("http_errors", robot_id, call="fetch")
+        scheduler.got_error()
+        return None, None
+    fetchedAt = time.monotonic()
+    if instruction:
+        scheduler.got_instruction()
+        metrics.observe("fetch", robot_id, fetchedAt - started)
     else:
-        raise Exception(f"Failed to fetch instructions. Error code: {response.status_code}")
-
-def send_event(robot_id, instruction_id, event_data):
-    url = f"{baseUrl}robot/{robot_id}/instructions/{instruction_id}/event"
-    headers = {'Content-Type': 'application/json'}
-    response = requests.post(url, data=json.dumps(event_data), headers=headers, auth=basicAuth)
-    if response.status_code != 200:
-        print(f"Failed to send event. Error code: {response.status_code}")
-
-def update_instruction(robot_id, instruction_id, responseData=""):
-    instruction_id = instruction_id.strip()
-    url = f"{baseUrl}robot/{robot_id}/instructions/{instruction_id}"
-    headers = {'Content-Type': 'application/json'}
-    response = requests.put(url, data=responseData ,headers=headers, auth=basicAuth)
-    if response.status_code != 202:
-        print(f"Failed to update instruction. Error code: {response.status_code}")
-
-async def execute_instruction(instruction, lego):
-    await lego.execute(instruction['Action'], instruction['Data'])
-
-async def main(robot_id):
-    def callBack():
-        print("Ready")
-    lego = LegoController(robot_id, callBack)
-    await lego.connect()
-    time.sleep(1)
+        scheduler.got_nothing()
+    scheduler.report(robot_id)
+    return instruction, fetchedAt
 
+# Pega leases an instruction to the robot it hands it to, and hands it out
+# again only if no result has come in when the lease runs out. Serial mode
+# waits until Pega has the result before it asks for the next instruction,
+# so Pega decides on the next one knowing how the last one ended.
+async def run_serial(robot_id, lego):
+    scheduler = create_scheduler()
     while True:
         try:
-            instruction = fetch_instructions(robot_id)
-            if instruction:
+            await outbox.join(robot_id)
+            instruction, fetchedAt = await poll_instruction(robot_id, scheduler)
+            if instruction and not await replay_result(robot_id, instruction):
                 try:
-                    await execute_instruction(instruction, lego)
-                    update_instruction(robot_id, instruction['UID'], lego.response)
+                    await execute_instruction(robot_id, instruction, lego, fetchedAt)
+                    await outbox.append(robot_id, instruction['UID'], "update", lego.response)
                 except LegoControllerException as e:
-                    send_event(robot_id, instruction['UID'], e.getData())
-            else:
-                time.sleep(1)  # Wait for new instructions if none are available
+                    await outbox.append(robot_id, instruction['UID'], "event", e.getData())
         except Exception as e:
             print(f"Error executing instruction: {e}")
+            scheduler.got_error()
             #send_event(robot_id, {'error': str(e)})
 
+# Pipelined mode: while the hub drives, the next instruction is already being
+# fetched and the previous result is uploaded from the outbox in the
+# background, strictly in execution order.
+async def run_pipelined(robot_id, lego):
+    recent = collections.deque(maxlen=16)
+    scheduler = create_scheduler()
+    instruction = None
+    fetchedAt = None
+    while True:
+        # poll_instruction() resets the poll delay for any instruction; one
+        # that is dropped below (invalid, running or replayed) backs it off
+        # again, so that Pega handing it back does not make us poll in a
+        # tight loop.
+        if instruction is None:
+            instruction, fetchedAt = await poll_instruction(robot_id, scheduler)
+            if instruction is None:
+                continue
+            if not is_valid_instruction(instruction) or await replay_result(robot_id, instruction):
+                instruction = None
+                scheduler.backoff()
+                await outbox.join(robot_id)
+                continue
+        uid = instruction['UID'].strip()
+        recent.append(uid)
+        prefetch = asyncio.create_task(poll_instruction(robot_id, scheduler))
+        collided = False
+        try:
+            await execute_instruction(robot_id, instruction, lego, fetchedAt)
+            await outbox.append(robot_id, uid, "update", lego.response)
+        except LegoControllerException as e:
+            await outbox.append(robot_id, uid, "event", e.getData())
+            collided = True
+        except Exception as e:
+            print(f"Error executing instruction: {e}")
+        instruction, fetchedAt = await prefetch
+        if collided:
+            # The event reaches Pega before the robot moves on. The
+            # prefetched instruction is leased to us, so it runs next; a
+            # dropped one would only come back once its lease ran out.
+            await outbox.join(robot_id)
+        if instruction is None:
+            continue
+        elif not is_valid_instruction(instruction):
+            instruction = None
+            scheduler.backoff()
+            await outbox.join(robot_id)
+        elif instruction['UID'].strip() in recent:
+            # The lease of an instruction that runs or waits for its upload
+            # that long has run out, so Pega handed it out again. Its result
+            # is on the way; it is dropped without a replay, which would
+            # send that result twice.
+            instruction = None
+            scheduler.backoff()
+            await outbox.join(robot_id)
+        elif await replay_result(robot_id, instruction):
+            instruction = None
+            scheduler.backoff()
+            await outbox.join(robot_id)
+
+async def run_robot(robot_id):
+    def callBack():
+        print(f"{robot_id} ready")
+    lego = LegoController(robot_id, callBack, timeout=settings.get('hubTimeout'),
+                          binary=settings.get('binaryFraming', False),
+                          addressCache=settings.get('addressCache'),
+                          reconnectMaxDelay=settings.get('reconnectMaxDelay', 10),
+                          metrics=metrics)
+    # Results left over from an earlier run are uploaded right away.
+    uploader = asyncio.create_task(upload_results(robot_id))
+    try:
+        async with connectLock:
+            await lego.connect()
+        await asyncio.sleep(1)
+
+        if settings.get('pipeline', False):
+            await run_pipelined(robot_id, lego)
+        else:
+            await run_serial(robot_id, lego)
+    except Exception as e:
+        print(f"Robot {robot_id} stopped: {e}")
+    finally:
+        uploader.cancel()
+
+async def main(robot_ids):
+    global connectLock
+    connectLock = asyncio.Lock()
+    if settings.get('metricsPort'):
+        metrics.serve(settings['metricsPort'])
+    try:
+        await asyncio.gather(*(run_robot(r) for r in robot_ids))
+    finally:
+        metrics.close()
+        outbox.close()
+        client.close()
+
 if __name__ == '__main__':
-    asyncio.run(main(robot_id))
-    pass
\ No newline at end of file
+    asyncio.run(main(robot_ids))
+    pass
@@ -0,0 +1,129 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Timings and counters of the bridge in the Prometheus text format, served on
+# a local HTTP endpoint. Everything is recorded from the event loop and read
+# by the HTTP server thread, hence the lock.
+
+# Upper bounds of the histogram buckets in seconds; hub commands may take
+# up to hubTimeout, Pega calls a few milliseconds.
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+# Phases of one instruction:
+# queue_wait   fetched instruction waiting for the hub (prefetch in pipeline mode)
+# fetch        instructions/next call that returned the instruction
+# ble_send     writing the command to the hub
+# hub_execute  command written until the hub's reply arrives
+# notification reply arrived until the waiting instruction resumes
+# update       result PUT or event POST to Pega
+PHASES = ["queue_wait", "fetch", "ble_send", "hub_execute", "notification", "update"]
+
+HISTOGRAMS = {
+    "phase_seconds": "Time spent per phase of an instruction",
+    "reconnect_seconds": "Time from a dropped hub link until the hub is connected again",
+}
+
+COUNTERS = {
+    "instructions": "Instructions executed",
+    "collisions": "Instructions stopped by a detected line",
+    "hub_events": "Instructions that ended in an event other than a collision",
+    "http_errors": "Failed calls to Pega",
+    "reconnects": "Reconnects to a hub after the link dropped",
+    "replays": "Re-delivered instructions answered with their stored result",
+}
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+# Label values are robot names from settings.yaml and may hold any
+# character; the text format needs \, " and newlines escaped.
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels):
+    return ",".join(f'{key}="{escape_label(value)}"' for key, value in labels)
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.server = None
+
+    def observe(self, phase, robot, seconds):
+        self.record("phase_seconds", seconds, ("robot", robot), ("phase", phase))
+
+    def observe_reconnect(self, robot, seconds):
+        self.record("reconnect_seconds", seconds, ("robot", robot))
+
+    def record(self, name, seconds, *labels):
+        key = (name,) + labels
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(seconds)
+
+    def count(self, name, robot, **labels):
+        key = (name, ("robot", robot)) + tuple(sorted(labels.items()))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, help in HISTOGRAMS.items():
+                lines.append(f"# HELP bridge_{name} {help}")
+                lines.append(f"# TYPE bridge_{name} histogram")
+                for key, histogram in sorted(self.histograms.items()):
+                    if key[0] != name:
+                        continue
+                    labels = format_labels(key[1:])
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS + ["+Inf"], histogram.counts):
+                        cumulative += count
+                        lines.append(f'bridge_{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                    lines.append(f"bridge_{name}_sum{{{labels}}} {histogram.sum:.6f}")
+                    lines.append(f"bridge_{name}_count{{{labels}}} {histogram.count}")
+            for name, help in COUNTERS.items():
+                lines.append(f"# HELP bridge_{name}_total {help}")
+                lines.append(f"# TYPE bridge_{name}_total counter")
+                for key, value in sorted(self.counters.items()):
+                    if key[0] == name:
+                        lines.append(f"bridge_{name}_total{{{format_labels(key[1:])}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, address="127.0.0.1"):
+        metrics = self
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((address, port), MetricsHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print(f"Metrics on http://{address}:{port}/metrics")
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
@@ -0,0 +1,130 @@
+import asyncio
+import concurrent.futures
+import json
+import sqlite3
+
+# Results and events waiting for Pega. Every result is appended to a SQLite
+# file before it is uploaded, so it survives Pega outages and restarts of the
+# bridge, and the uploader hands them to Pega strictly in order per robot.
+# A robot reports at most one result per instruction UID; later ones for the
+# same UID are dropped. The most recent KEEP_SENT results stay after their
+# upload, so an instruction Pega hands out again is answered with its stored
+# result instead of being executed twice (see replay).
+# The queries run on one worker thread, so that SQLite waiting for the disk
+# does not hold up the event loop and with it the other robots.
+
+# Entries read and uploaded per round trip to the database.
+BATCH_SIZE = 20
+# Uploaded entries kept for deduplication before they are purged.
+KEEP_SENT = 1000
+
+class Outbox:
+    def __init__(self, path=None):
+        # Created on import, used from the worker thread afterwards.
+        self.db = sqlite3.connect(path or ":memory:", check_same_thread=False)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS outbox (
+                           id INTEGER PRIMARY KEY AUTOINCREMENT,
+                           robot TEXT NOT NULL,
+                           uid TEXT NOT NULL,
+                           kind TEXT NOT NULL,
+                           data TEXT NOT NULL,
+                           sent INTEGER NOT NULL DEFAULT 0,
+                           UNIQUE (robot, uid))""")
+        self.db.commit()
+        # Results per robot left over from an earlier run.
+        self.leftover = dict(self.db.execute("SELECT robot, COUNT(*) FROM outbox WHERE sent = 0 GROUP BY robot").fetchall())
+        # Per robot: set while entries are waiting, cleared once all are sent.
+        self.waiting = {}
+        self.drained = {}
+
+    async def run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def events(self, robot):
+        if robot not in self.waiting:
+            self.waiting[robot] = asyncio.Event()
+            self.drained[robot] = asyncio.Event()
+            if self.leftover.get(robot, 0) > 0:
+                self.waiting[robot].set()
+            else:
+                self.drained[robot].set()
+        return self.waiting[robot], self.drained[robot]
+
+    def added(self, robot):
+        waiting, drained = self.events(robot)
+        drained.clear()
+        waiting.set()
+
+    async def append(self, robot, uid, kind, data):
+        if not await self.run(self.insert, robot, uid.strip(), kind, json.dumps(data)):
+            print(f"Result for instruction {uid} is already in the outbox")
+            return False
+        self.added(robot)
+        return True
+
+    def insert(self, robot, uid, kind, data):
+        cursor = self.db.execute("INSERT OR IGNORE INTO outbox (robot, uid, kind, data) VALUES (?, ?, ?, ?)",
+                                 (robot, uid, kind, data))
+        self.db.commit()
+        return cursor.rowcount > 0
+
+    # Queues the stored result of an instruction for another upload unless it
+    # is still waiting for its first; returns False if this robot has no
+    # result for the UID.
+    async def replay(self, robot, uid):
+        found, requeued = await self.run(self.requeue, robot, uid.strip())
+        if requeued:
+            self.added(robot)
+        return found
+
+    # Moves an uploaded result to the end of the queue; returns whether the
+    # UID has a result and whether it was moved.
+    def requeue(self, robot, uid):
+        row = self.db.execute("SELECT kind, data, sent FROM outbox WHERE robot = ? AND uid = ?",
+                              (robot, uid)).fetchone()
+        if row is None:
+            return False, False
+        if not row[2]:
+            return True, False
+        self.db.execute("DELETE FROM outbox WHERE robot = ? AND uid = ?", (robot, uid))
+        self.insert(robot, uid, row[0], row[1])
+        return True, True
+
+    def count(self, robot):
+        return self.db.execute("SELECT COUNT(*) FROM outbox WHERE robot = ? AND sent = 0", (robot,)).fetchone()[0]
+
+    def pending(self, robot, limit=BATCH_SIZE):
+        rows = self.db.execute("SELECT id, uid, kind, data FROM outbox WHERE robot = ? AND sent = 0 ORDER BY id LIMIT ?",
+                               (robot, limit)).fetchall()
+        return [(id, uid, kind, json.loads(data)) for id, uid, kind, data in rows]
+
+    async def mark_sent(self, robot, ids):
+        if await self.run(self.update_sent, robot, ids) == 0:
+            waiting, drained = self.events(robot)
+            waiting.clear()
+            drained.set()
+
+    # Returns how many results of the robot are still waiting.
+    def update_sent(self, robot, ids):
+        if ids:
+            self.db.executemany("UPDATE outbox SET sent = 1 WHERE id = ?", [(id,) for id in ids])
+            self.db.execute("DELETE FROM outbox WHERE sent = 1 AND id <= (SELECT MAX(id) FROM outbox) - ?", (KEEP_SENT,))
+            self.db.commit()
+        return self.count(robot)
+
+    async def next_batch(self, robot):
+        waiting, _ = self.events(robot)
+        await waiting.wait()
+        return await self.run(self.pending, robot)
+
+    # Waits until Pega has every result of this robot.
+    async def join(self, robot):
+        _, drained = self.events(robot)
+        await drained.wait()
+
+    def close(self):
+        self.executor.shutdown()
+        self.db.close()
@@ -0,0 +1,110 @@
+import asyncio
+import concurrent.futures
+import functools
+import json
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
+
+# Async facade over one pooled, keep-alive requests session.
+# The blocking calls run in a worker thread so the bleak event loop keeps
+# receiving hub notifications while we wait on Pega.
+
+class PegaClientException(Exception):
+    def __init__(self, type, status=None):
+        self.type = type
+        self.status = status
+
+    def getData(self):
+        return {"type": self.type, "status": self.status}
+
+    # Client errors other than timeouts and throttling fail again on a retry.
+    def isPermanent(self):
+        return self.status is not None and 400 <= self.status < 500 and self.status not in (408, 429)
+
+class PegaClient:
+    def __init__(self, baseUrl, userName, password, timeout=10, retries=3, backoff=0.5, poolSize=4):
+        self.baseUrl = baseUrl
+        self.timeout = timeout
+        # Connection errors are retried for every method, status and read
+        # errors only for the idempotent PUT (result).
+        self.session = self.create_session(userName, password, poolSize, Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=[429, 502, 503, 504],
+            allowed_methods=["PUT"],
+            raise_on_status=False,
+        ))
+        # GET instructions/next leases the instruction it returns, so it is
+        # not idempotent: after a lost answer a retry gets the instruction
+        # behind the leased one. It is only retried when it did not go out.
+        self.fetchSession = self.create_session(userName, password, poolSize, Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=0,
+            other=0,
+            backoff_factor=backoff,
+            raise_on_status=False,
+        ))
+        # Own worker threads, one per pooled connection: long polls of several
+        # robots must not starve the loop's small default executor.
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=poolSize, thread_name_prefix="pega")
+
+    def create_session(self, userName, password, poolSize, retry):
+        session = requests.Session()
+        session.auth = HTTPBasicAuth(userName, password)
+        adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize, max_retries=retry)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    async def request(self, method, path, timeout=None, session=None, **kwargs):
+        url = f"{self.baseUrl}{path}"
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            call = functools.partial((session or self.session).request, method, url, timeout=timeout, **kwargs)
+            return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+        except requests.RequestException as e:
+            raise PegaClientException(type(e).__name__) from e
+
+    async def fetch_instructions(self, robot_id, timeout=None, wait=None):
+        params = None
+        if wait:
+            # Long poll: the server may hold the request for up to 'wait' seconds.
+            params = {'wait': wait}
+            timeout = (timeout or self.timeout) + wait
+        response = await self.request("GET", f"robot/{robot_id}/instructions/next", timeout=timeout,
+                                      session=self.fetchSession, params=params)
+        if response.status_code == 200:
+            return response.json()
+        elif response.status_code == 204:
+            return None
+        else:
+            raise PegaClientException("fetch", response.status_code)
+
+    async def send_event(self, robot_id, instruction_id, event_data, timeout=None):
+        headers = {'Content-Type': 'application/json'}
+        response = await self.request("POST", f"robot/{robot_id}/instructions/{instruction_id}/event",
+                                      timeout=timeout, data=json.dumps(event_data), headers=headers)
+        if response.status_code != 200:
+            print(f"Failed to send event. Error code: {response.status_code}")
+            raise PegaClientException("event", response.status_code)
+        return True
+
+    async def update_instruction(self, robot_id, instruction_id, responseData="", timeout=None):
+        instruction_id = instruction_id.strip()
+        headers = {'Content-Type': 'application/json'}
+        response = await self.request("PUT", f"robot/{robot_id}/instructions/{instruction_id}",
+                                      timeout=timeout, data=responseData, headers=headers)
+        if response.status_code != 202:
+            print(f"Failed to update instruction. Error code: {response.status_code}")
+            raise PegaClientException("update", response.status_code)
+        return True
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
+        self.fetchSession.close()
@@ -0,0 +1,78 @@
+import collections
+import random
+import time
+
+# Decides how long to wait between polls of instructions/next.
+# If the server supports long-polling (it holds the request for up to
+# 'longPoll' seconds until work arrives) we re-poll immediately after an empty
+# answer. Otherwise, and after errors, the delay grows exponentially with jitter
+# and drops back to zero as soon as an instruction arrives.
+# Keep in sync with the copy in Camera Embedded.
+
+FAST_EMPTY_LIMIT = 3
+
+class PollScheduler:
+    def __init__(self, minDelay=0.1, maxDelay=5.0, factor=2.0, jitter=0.2, longPoll=0, window=60):
+        self.minDelay = minDelay
+        self.maxDelay = maxDelay
+        self.factor = factor
+        self.jitter = jitter
+        self.longPoll = longPoll
+        self.window = window
+        self.delay = 0
+        self.fastEmpty = 0
+        self.started = 0
+        self.polls = collections.deque()
+        self.lastReport = time.monotonic()
+
+    def long_poll_wait(self):
+        if self.longPoll > 0 and self.fastEmpty < FAST_EMPTY_LIMIT:
+            return self.longPoll
+        return None
+
+    def poll_started(self):
+        self.started = time.monotonic()
+        self.polls.append(self.started)
+
+    def got_instruction(self):
+        self.delay = 0
+        # Fast 204s only count while nothing arrives in between, so that a
+        # few short waits now and then do not end long polling for good.
+        self.fastEmpty = 0
+
+    def got_nothing(self):
+        wait = self.long_poll_wait()
+        if wait is not None:
+            if time.monotonic() - self.started >= wait / 2:
+                # The server held the request, so it is safe to ask again now.
+                self.fastEmpty = 0
+                self.delay = 0
+                return
+            # An immediate 204 means the server ignores 'wait'; after a few of
+            # those we stop asking for long polls and back off instead.
+            self.fastEmpty += 1
+        self.backoff()
+
+    def got_error(self):
+        self.backoff()
+
+    def backoff(self):
+        self.delay = min(self.maxDelay, max(self.minDelay, self.delay * self.factor))
+
+    def next_delay(self):
+        if self.delay == 0:
+            return 0
+        return self.delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def poll_rate(self):
+        now = time.monotonic()
+        while self.polls and self.polls[0] < now - self.window:
+            self.polls.popleft()
+        return len(self.polls) / self.window
+
+    def report(self, name=""):
+        now = time.monotonic()
+        if now - self.lastReport >= self.window:
+            self.lastReport = now
+            mode = "long-poll" if self.long_poll_wait() is not None else "backoff"
+            print(f"{name} polling at {self.poll_rate():.2f}/s ({mode}, delay {self.delay:.2f}s)")
@@ -1,10 +1,19 @@
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 import json
+import os
+import queue
+import threading
 import time
 import yaml
 import io
 import picamera
+from encoding import DEFAULT_PROFILE, load_profiles
+from multipart import MultipartBody
+from poll_scheduler import PollScheduler
+from result_cache import ResultCache
+from token_manager import TokenManager
 
 setting = {}
 with open("settings.yaml", "r") as yamlfile:
@@ -16,11 +25,25 @@ baseUrl = settings['baseUrl']
 requestUrl = "robot/"+robot_id+"/instructions/next"
 basicAuth = HTTPBasicAuth(settings['userName'], settings['password'])
 pegaAPIUrl = settings['pegaAPIUrl']
-pegaToken = ""
+# One keep-alive session for every call, shared by the threads of the
+# pipelined agent: the poll loop, uploads, attachments and token refreshes.
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+session.mount("https://", adapter)
+session.mount("http://", adapter)
+tokens = TokenManager(settings['pegaAPIOAuthUrl'], settings['pegaAPIClient'], settings['pegaAPISecret'],
+                      margin=settings.get('tokenRefreshMargin', 60), timeout=settings.get('httpTimeout', 10),
+                      session=session)
 
-def fetch_instructions(robot_id):
+def fetch_instructions(robot_id, wait=None):
     url = f"{baseUrl}robot/{robot_id}/instructions/next"
-    response = requests.get(url, auth=basicAuth)
+    params = None
+    timeout = settings.get('httpTimeout', 10)
+    if wait:
+        # Long poll: the server may hold the request for up to 'wait' seconds.
+        params = {'wait': wait}
+        timeout = timeout + wait
+    response = session.get(url, auth=basicAuth, params=params, timeout=timeout)
     if response.status_code == 200:
         return response.json()
     elif response.status_code == 204:
@@ -31,7 +54,7 @@ def fetch_instructions(robot_id):
 def send_event(robot_id, instruction_id, event_data):
     url = f"{baseUrl}robot/{robot_id}/instructions/{instruction_id}/event"
     headers = {'Content-Type': 'application/json'}
-    response = requests.post(url, data=json.dumps(event_data), headers=headers, auth=basicAuth)
+    response = session.post(url, data=json.dumps(event_data), headers=headers, auth=basicAuth)
     if response.status_code != 200:
         print(f"Failed to send event. Error code: {response.status_code}")
 
@@ -39,7 +62,7 @@ def update_instruction(robot_id, instruction_id, responseData=""):
     instruction_id = instruction_id.strip()
     url = f"{baseUrl}robot/{robot_id}/instructions/{instruction_id}"
     headers = {'Content-Type': 'application/json'}
-    response = requests.put(url, data=responseData ,headers=headers, auth=basicAuth)
+    response = session.put(url, data=responseData ,headers=headers, auth=basicAuth)
     if response.status_code != 202:
         print(f"Failed to update instruction. Error code: {response.status_code}")
 
@@ -59,89 +82,280 @@ class CameraController:
         self.processing = False
         self.response = ""
         self.camera = picamera.PiCamera()
-        self.resolution = "medium"
-        self.camera.resolution = (1920, 1080)
+        self.profiles = load_profiles(settings.get('profiles'))
+        self.setResolution(DEFAULT_PROFILE)
 
     def execute(self, action, parameters):
         action = action.lower()
         self.processing = True
+        self.response = ""
         params = parameters.split("|")
+        frames = self.capture(action, params)
+        if frames:
+            self.attach_photos_to_case(frames, params[0], params[1])
+
+    # photo>[caseid]|[category]|[resolution]|[filename]
+    # burst>[caseid]|[category]|[resolution]|[filename]|[frames]|[interval]
+    # Returns the photos taken as (filename, BytesIO).
+    def capture(self, action, params):
         if (action == "photo"):
             self.setResolution(params[2])
-            photo = self.capture_photo()
-            self.attach_photo_to_case(photo, params[0], params[1], params[3])
+            return [(params[3], self.capture_photo())]
+        if (action == "burst"):
+            try:
+                count = int(params[4]) if len(params) > 4 and params[4] else settings.get('burstFrames', 3)
+                interval = float(params[5]) if len(params) > 5 and params[5] else 0
+            except ValueError:
+                raise CameraControllerException("invalidburst")
+            if count < 1 or count > settings.get('burstMaxFrames', 10) or interval < 0:
+                raise CameraControllerException("invalidburst")
+            self.setResolution(params[2])
+            return self.capture_burst(params[3], count, interval)
+        return []
 
+    # Returns the BytesIO the camera wrote the JPEG to; it is uploaded from
+    # there without a copy (see multipart.py).
     def capture_photo(self):
         stream = io.BytesIO()
-        self.camera.capture(stream, format='jpeg')
-        stream.seek(0)
-        photo = stream.read()
+        quality = self.profile.next_quality()
+        self.camera.capture(stream, format='jpeg', quality=quality)
+        self.profile.record(quality, stream.tell())
         print("Photo taken")
-        print(len(photo))
-        return photo
+        print(stream.tell())
+        return stream
+
+    # Takes 'count' frames through the video port, which does not switch the
+    # sensor mode for every frame like the still port does: back to back, or
+    # one every 'interval' seconds. The frames are named [filename]-1 etc.
+    def capture_burst(self, filename, count, interval):
+        streams = [io.BytesIO() for i in range(count)]
+        quality = self.profile.next_quality()
+        if interval > 0:
+            started = time.monotonic()
+            for i, stream in enumerate(streams):
+                time.sleep(max(0, started + i * interval - time.monotonic()))
+                self.camera.capture(stream, format='jpeg', use_video_port=True, quality=quality)
+        else:
+            self.camera.capture_sequence(streams, format='jpeg', use_video_port=True, quality=quality)
+        for stream in streams:
+            self.profile.record(quality, stream.tell())
+        print(f"{count} frames taken")
+        base, extension = os.path.splitext(filename)
+        return [(f"{base}-{i + 1}{extension}", stream) for i, stream in enumerate(streams)]
     
+    # Selects the encoding profile (see encoding.py); unknown names get the
+    # default profile. The camera is only reconfigured when something changes.
     def setResolution(self, resolution):
         self.resolution = resolution
-        if (resolution == "low"):
-            self.camera.resolution = (1024, 768)
-        elif (resolution == "high"):
-            self.camera.resolution = (2560, 1440)
-        else:
-            self.camera.resolution = (1920, 1080)
+        self.profile = self.profiles.get(resolution, self.profiles[DEFAULT_PROFILE])
+        if self.camera.resolution != self.profile.resolution:
+            self.camera.resolution = self.profile.resolution
+        colorEffects = (128, 128) if self.profile.grayscale else None
+        if self.camera.color_effects != colorEffects:
+            self.camera.color_effects = colorEffects
+        if self.camera.zoom != self.profile.crop:
+            self.camera.zoom = self.profile.crop
     
-    def attach_photo_to_case(self, photo, caseid, category, filename):
+    def attach_photos_to_case(self, frames, caseid, category):
+        uploads = self.upload_photos(frames, caseid, category)
+        if uploads:
+            self.response = ",".join(id for filename, id in uploads)
+            self.attach_to_case(uploads, caseid, category)
+
+    # Returns (filename, attachment ID) of every photo that was uploaded.
+    def upload_photos(self, frames, caseid, category):
+        uploads = []
+        for filename, photo in frames:
+            id = self.upload_photo(photo, caseid, category, filename)
+            if (id != ""):
+                uploads.append((filename, id))
+        return uploads
+
+    # Returns the attachment ID, or "" if the upload failed.
+    def upload_photo(self, photo, caseid, category, filename):
         print("uploading > " + caseid + " | " + category + " | " + filename)
-        pegaToken = get_access_token(settings['pegaAPIOAuthUrl'], settings['pegaAPIClient'], settings['pegaAPISecret'])
         url = f"{pegaAPIUrl}/attachments/upload"
-        headers = {'Authorization': 'Bearer ' + pegaToken}
-        files = {'content': photo}
+        fn = filename if filename is not None else settings['attachment_filename']
+        body = MultipartBody([('content', fn, 'image/jpeg', photo.getbuffer())])
         id = ""
-        response = requests.post(url, files=files, headers=headers)
+        response = post_with_token(url, data=body, headers={'Content-Type': body.contentType})
         print(response.status_code)
         if response.status_code == 201:
             print("uploaded")
             data = json.loads(response.text)
             print(response.text)
             id = data['ID']
-            self.response = id
-        
-        if (id != ""):
-            print("attaching")
-            url = f"{pegaAPIUrl}/cases/{caseid}/attachments"
-            headers = {'Authorization': 'Bearer ' + pegaToken}
-            cat = settings['attachment_category']
-            if (category is not None):
-                cat = category
+        return id
+
+    # Attaches all uploads to the case in one call.
+    def attach_to_case(self, uploads, caseid, category):
+        print("attaching")
+        url = f"{pegaAPIUrl}/cases/{caseid}/attachments"
+        cat = settings['attachment_category']
+        if (category is not None):
+            cat = category
+        attachments = []
+        for filename, id in uploads:
             fn = settings['attachment_filename']
             if (filename is not None):
                 fn = filename
-            data ="{\"attachments\": [{\"attachmentFieldName\": \""+ fn +"\",\"ID\": \""+id+"\", \"category\": \""+ cat +"\", \"delete\": true,\"name\": \""+ fn +"\",\"type\": \"File\"}]}"
-            response = requests.post(url, data=data, headers=headers)
+            attachments.append({"attachmentFieldName": fn, "ID": id, "category": cat, "delete": True,
+                                "name": fn, "type": "File"})
+        post_with_token(url, data=json.dumps({"attachments": attachments}))
 
-def get_access_token(url, client_id, client_secret):
-    response = requests.post(
-        url,
-        data={"grant_type": "client_credentials"},
-        auth=(client_id, client_secret),
-    )
-    return response.json()["access_token"]
+# POST to the Pega application API with the cached bearer token. A 401 means
+# Pega no longer accepts the token (e.g. after a restart); it is dropped and
+# the call is made once more with a new one.
+def post_with_token(url, headers=None, **kwargs):
+    headers = dict(headers or {})
+    token = tokens.get()
+    headers['Authorization'] = 'Bearer ' + token
+    response = session.post(url, headers=headers, **kwargs)
+    if response.status_code == 401:
+        tokens.invalidate(token)
+        headers['Authorization'] = 'Bearer ' + tokens.get()
+        response = session.post(url, headers=headers, **kwargs)
+    return response
+
+def report_result(robot_id, instruction_id, kind, data):
+    if kind == "event":
+        send_event(robot_id, instruction_id, data)
+    else:
+        update_instruction(robot_id, instruction_id, data)
+
+def execute_serial(robot_id, instruction, camera, results):
+    # The result is stored before it is sent, so an instruction
+    # Pega hands out again is answered without another photo.
+    result = results.get(instruction['UID'])
+    if result is not None:
+        print(f"Instruction {instruction['UID']} was already executed, sending its result again")
+    else:
+        try:
+            execute_instruction(instruction, camera)
+            result = ("update", camera.response)
+        except CameraControllerException as e:
+            result = ("event", e.getData())
+        results.put(instruction['UID'], *result)
+    report_result(robot_id, instruction['UID'], *result)
+
+class PhotoJob:
+    def __init__(self, instruction):
+        self.uid = instruction['UID'].strip()
+        self.action = instruction['Action'].lower()
+        self.params = instruction['Data'].split("|")
+        self.frames = []
+        self.uploads = []
+        # Set by the stage that failed; the later stages pass the job on, so
+        # that its result is reported in order, too.
+        self.failed = False
+        self.result = None
+
+# Pipelined agent: the camera, uploads and attachments each run on their own
+# thread, connected by queues of at most 'depth' instructions, so the camera
+# takes the next photo while the previous one is still on its way to Pega
+# and the queue is polled meanwhile. When the queues are full the poll loop
+# waits. Results are reported in the order the instructions came in.
+class CameraPipeline:
+    def __init__(self, robot_id, camera, results, depth=2):
+        self.robot_id = robot_id
+        self.camera = camera
+        self.results = results
+        self.lock = threading.Lock()
+        # UIDs between submit and their result, so a re-delivered instruction
+        # is not started a second time.
+        self.inFlight = set()
+        self.captures = queue.Queue(depth)
+        self.uploads = queue.Queue(depth)
+        self.attachments = queue.Queue(depth)
+        for name, work, inbox, outbox in (("capture", self.capture, self.captures, self.uploads),
+                                          ("upload", self.upload, self.uploads, self.attachments),
+                                          ("attach", self.attach, self.attachments, None)):
+            threading.Thread(target=self.run_stage, args=(name, work, inbox, outbox), daemon=True).start()
+
+    def submit(self, instruction):
+        uid = instruction['UID'].strip()
+        with self.lock:
+            if uid in self.inFlight:
+                print(f"Instruction {uid} is still being executed")
+                return
+            result = self.results.get(uid)
+            if result is None:
+                self.inFlight.add(uid)
+        if result is not None:
+            print(f"Instruction {uid} was already executed, sending its result again")
+            report_result(self.robot_id, uid, *result)
+            return
+        self.captures.put(PhotoJob(instruction))
+
+    def capture(self, job):
+        job.frames = self.camera.capture(job.action, job.params)
+
+    def upload(self, job):
+        if job.frames:
+            job.uploads = self.camera.upload_photos(job.frames, job.params[0], job.params[1])
+            job.frames = []
+
+    def attach(self, job):
+        if job.uploads:
+            self.camera.attach_to_case(job.uploads, job.params[0], job.params[1])
+
+    def run_stage(self, name, work, inbox, outbox):
+        while True:
+            job = inbox.get()
+            if not job.failed:
+                try:
+                    work(job)
+                except CameraControllerException as e:
+                    job.failed = True
+                    job.result = ("event", e.getData())
+                except Exception as e:
+                    # No result: Pega hands the instruction out again later.
+                    print(f"Error in {name} of instruction {job.uid}: {e}")
+                    job.failed = True
+                if job.failed:
+                    job.frames = []
+            if outbox is not None:
+                outbox.put(job)
+            elif job.failed:
+                self.finish(job, job.result)
+            else:
+                self.finish(job, ("update", ",".join(id for filename, id in job.uploads)))
+
+    def finish(self, job, result):
+        if result is not None:
+            with self.lock:
+                self.results.put(job.uid, *result)
+            report_result(self.robot_id, job.uid, *result)
+        with self.lock:
+            self.inFlight.discard(job.uid)
 
 def main(robot_id):
     camera = CameraController(robot_id)
+    results = ResultCache(settings.get('resultCacheSize', 256), settings.get('resultCache'))
+    pipeline = None
+    if settings.get('pipeline', False):
+        pipeline = CameraPipeline(robot_id, camera, results, settings.get('pipelineDepth', 2))
+    scheduler = PollScheduler(minDelay=settings.get('pollMinDelay', 0.1),
+                              maxDelay=settings.get('pollMaxDelay', 5.0),
+                              longPoll=settings.get('longPoll', 0))
     print("Agent started")
     while True:
+        time.sleep(scheduler.next_delay())
         try:
-            instruction = fetch_instructions(robot_id)
+            scheduler.poll_started()
+            instruction = fetch_instructions(robot_id, scheduler.long_poll_wait())
             if instruction:
-                try:
-                    execute_instruction(instruction, camera)
-                    update_instruction(robot_id, instruction['UID'], camera.response)
-                except CameraControllerException as e:
-                    send_event(robot_id, instruction['UID'], e.getData())
+                scheduler.got_instruction()
+                if pipeline is not None:
+                    pipeline.submit(instruction)
+                else:
+                    execute_serial(robot_id, instruction, camera, results)
             else:
-                time.sleep(1)  # Wait for new instructions if none are available
+                scheduler.got_nothing()
         except Exception as e:
             print(f"Error executing instruction: {e}")
+            scheduler.got_error()
+        scheduler.report(robot_id)
 
 if __name__ == '__main__':
     main(robot_id)
\ No newline at end of file
@@ -0,0 +1,87 @@
+import collections
+import math
+
+# Encoding profiles for photos: resolution, JPEG quality, and optionally
+# grayscale and a crop of the sensor image. A photo or burst instruction
+# names its profile in the resolution parameter; low, medium and high are
+# always there and can be changed in settings.yaml (profiles).
+# A profile with targetBytes picks the JPEG quality itself. The size of a
+# JPEG grows slowly with the quality at first and steeply above about 85, so
+# each photo's quality is a step from the last one: the log of the ratio
+# between target and last size, divided by the slope of log size over
+# quality seen in the last few photos, and damped so that a change of scene
+# or a poor slope estimate does not make the quality swing. This keeps the
+# upload time of a photo steady when the scene changes.
+
+DEFAULT_PROFILES = {
+    "low": {"resolution": [1024, 768]},
+    "medium": {"resolution": [1920, 1080]},
+    "high": {"resolution": [2560, 1440]},
+}
+DEFAULT_PROFILE = "medium"
+DEFAULT_QUALITY = 85 # picamera's default JPEG quality
+MIN_QUALITY = 10
+MAX_QUALITY = 95
+# Photos per profile that the slope for a size target is estimated from.
+RECENT = 3
+# Part of the step to the target that is taken per photo.
+DAMPING = 0.5
+# Change of log size per quality step: assumed until two recent photos have
+# different qualities (or when the scene changed so much that the size fell
+# as the quality rose), and the range estimates are kept in.
+DEFAULT_SLOPE = 0.03
+MIN_SLOPE = 0.01
+MAX_SLOPE = 0.2
+
+class EncodingProfile:
+    def __init__(self, name, resolution=(1920, 1080), quality=DEFAULT_QUALITY, grayscale=False, crop=None, targetBytes=None):
+        if not isinstance(quality, int) or not 1 <= quality <= 100:
+            raise ValueError(f"Profile {name}: quality must be a whole number from 1 to 100, not {quality!r}")
+        if targetBytes is not None and (not isinstance(targetBytes, int) or targetBytes <= 0):
+            raise ValueError(f"Profile {name}: targetBytes must be a positive number of bytes, not {targetBytes!r}")
+        self.name = name
+        self.resolution = tuple(resolution)
+        self.quality = quality
+        self.grayscale = grayscale
+        # (x, y, width, height) of the sensor image as fractions, picamera's zoom
+        self.crop = tuple(crop) if crop else (0.0, 0.0, 1.0, 1.0)
+        self.targetBytes = targetBytes
+        self.recent = collections.deque(maxlen=RECENT)
+
+    def next_quality(self):
+        if not self.targetBytes or not self.recent:
+            return self.quality
+        quality, size = self.recent[-1]
+        step = math.log(self.targetBytes / size) / self.slope()
+        move = round(DAMPING * step)
+        if move == 0 and abs(step) > 0.5:
+            # Damping alone would leave the size up to two steps off where
+            # the steps are large.
+            move = 1 if step > 0 else -1
+        return max(MIN_QUALITY, min(MAX_QUALITY, quality + move))
+
+    # From the last photo and the latest one before it with another quality.
+    def slope(self):
+        quality, size = self.recent[-1]
+        for earlierQuality, earlierSize in reversed(list(self.recent)[:-1]):
+            if earlierQuality != quality:
+                slope = math.log(size / earlierSize) / (quality - earlierQuality)
+                if slope > 0:
+                    return max(MIN_SLOPE, min(MAX_SLOPE, slope))
+                break
+        return DEFAULT_SLOPE
+
+    # Frames of a burst share their quality; only the latest size is kept, so
+    # that the earlier qualities stay for the slope.
+    def record(self, quality, size):
+        if size <= 0:
+            return
+        if self.recent and self.recent[-1][0] == quality:
+            self.recent.pop()
+        self.recent.append((quality, size))
+
+def load_profiles(settings):
+    definitions = dict(DEFAULT_PROFILES)
+    for name, definition in (settings or {}).items():
+        definitions[name] = dict(DEFAULT_PROFILES.get(name, {}), **definition)
+    return {name: EncodingProfile(name, **definition) for name, definition in definitions.items()}
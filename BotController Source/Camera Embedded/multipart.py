@@ -0,0 +1,38 @@
+import binascii
+import os
+
+# multipart/form-data body for uploads that does not copy the files: the
+# parts are handed to requests as slices of the files' buffers (e.g.
+# BytesIO.getbuffer() of a capture) between the small part headers. With its
+# length known, requests sends it with a Content-Length and reads it
+# chunk by chunk instead of building the whole body in memory. The body can
+# be sent more than once, e.g. again after a 401.
+
+CHUNK_SIZE = 64 * 1024
+
+class MultipartBody:
+    # files: (field name, file name, content type, buffer) per part
+    def __init__(self, files):
+        self.boundary = binascii.hexlify(os.urandom(16)).decode("ascii")
+        self.parts = []
+        for name, filename, contentType, buffer in files:
+            header = (f"--{self.boundary}\r\n"
+                      f"Content-Disposition: form-data; name=\"{name}\"; filename=\"{filename}\"\r\n"
+                      f"Content-Type: {contentType}\r\n\r\n").encode("utf-8")
+            self.parts.append((header, memoryview(buffer).cast("B")))
+        self.trailer = f"--{self.boundary}--\r\n".encode("ascii")
+
+    @property
+    def contentType(self):
+        return "multipart/form-data; boundary=" + self.boundary
+
+    def __len__(self):
+        return sum(len(header) + len(data) + 2 for header, data in self.parts) + len(self.trailer)
+
+    def __iter__(self):
+        for header, data in self.parts:
+            yield header
+            for start in range(0, len(data), CHUNK_SIZE):
+                yield data[start:start + CHUNK_SIZE]
+            yield b"\r\n"
+        yield self.trailer
@@ -0,0 +1,50 @@
+import collections
+import json
+import os
+
+# Results of the most recent instructions by UID. Pega hands out an
+# instruction again when our result did not reach it; such an instruction is
+# answered from here instead of taking and uploading another photo.
+# The least recently used entries are evicted beyond maxSize. With a path the
+# cache is kept in a JSON file and survives restarts of the agent.
+
+class ResultCache:
+    def __init__(self, maxSize=256, path=None):
+        self.maxSize = maxSize
+        self.path = path
+        self.results = collections.OrderedDict()
+        if path is not None:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        for uid, kind, data in entries[-self.maxSize:]:
+            self.results[uid] = (kind, data)
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump([[uid, kind, data] for uid, (kind, data) in self.results.items()], f)
+        os.replace(tmp, self.path)
+
+    # Returns (kind, data) of an executed instruction, or None.
+    def get(self, uid):
+        uid = uid.strip()
+        if uid not in self.results:
+            return None
+        self.results.move_to_end(uid)
+        return self.results[uid]
+
+    def put(self, uid, kind, data):
+        uid = uid.strip()
+        self.results[uid] = (kind, data)
+        self.results.move_to_end(uid)
+        while len(self.results) > self.maxSize:
+            self.results.popitem(last=False)
+        self.save()
@@ -0,0 +1,81 @@
+import threading
+import time
+
+import requests
+
+# Bearer token for the Pega application API (OAuth client credentials).
+# The token is fetched once and kept until shortly before it expires: within
+# 'margin' seconds of the expiry it is still handed out while a new one is
+# fetched in the background. Callers that need a token while none is valid
+# share a single fetch instead of each asking the token endpoint.
+
+# Lifetime assumed when the token endpoint does not send expires_in.
+DEFAULT_LIFETIME = 300
+
+class TokenManager:
+    def __init__(self, url, clientId, clientSecret, margin=60, timeout=10, session=None):
+        self.url = url
+        self.session = session or requests.Session()
+        self.clientId = clientId
+        self.clientSecret = clientSecret
+        self.margin = margin
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.token = None
+        self.expiresAt = 0
+        self.refreshAt = 0
+        self.refreshing = False
+        self.fetches = 0
+
+    def valid(self):
+        return self.token is not None and time.monotonic() < self.expiresAt
+
+    def get(self):
+        with self.condition:
+            while self.refreshing and not self.valid():
+                self.condition.wait()
+            if self.valid():
+                if time.monotonic() >= self.refreshAt and not self.refreshing:
+                    self.refreshing = True
+                    threading.Thread(target=self.refresh_in_background, daemon=True).start()
+                return self.token
+            self.refreshing = True
+        self.refresh()
+        with self.condition:
+            return self.token
+
+    # Drops a token Pega refused (401), unless it was replaced already, so
+    # that the next get() fetches a new one.
+    def invalidate(self, token):
+        with self.condition:
+            if self.token == token:
+                self.token = None
+
+    def fetch(self):
+        self.fetches += 1
+        response = self.session.post(self.url, data={"grant_type": "client_credentials"},
+                                     auth=(self.clientId, self.clientSecret), timeout=self.timeout)
+        if response.status_code != 200:
+            raise Exception(f"Failed to get an access token. Error code: {response.status_code}")
+        data = response.json()
+        return data["access_token"], float(data.get("expires_in", DEFAULT_LIFETIME))
+
+    # Called by the one caller that set 'refreshing'.
+    def refresh(self):
+        try:
+            token, lifetime = self.fetch()
+            with self.condition:
+                now = time.monotonic()
+                self.token = token
+                self.expiresAt = now + lifetime
+                self.refreshAt = self.expiresAt - min(self.margin, lifetime / 2)
+        finally:
+            with self.condition:
+                self.refreshing = False
+                self.condition.notify_all()
+
+    def refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            print(f"Error refreshing the access token: {e}")
@@ -0,0 +1,36 @@
+import argparse
+import statistics
+
+import fake_picamera
+import harness
+
+# JPEG sizes of a series of photos with a fixed quality and with a size
+# target, on the fake picamera with a scene whose detail changes from photo
+# to photo (fake_picamera.sceneVariation), and the upload time they mean
+# over a link of --bandwidth Mbit/s.
+
+def percentile(values, p):
+    return statistics.quantiles(values, n=100)[p - 1]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Photo sizes with a fixed JPEG quality vs a size target")
+    parser.add_argument("--photos", type=int, default=100)
+    parser.add_argument("--target", type=int, default=150000, help="bytes per photo of the target profile")
+    parser.add_argument("--variation", type=float, default=0.1, help="change of scene detail per photo")
+    parser.add_argument("--bandwidth", type=float, default=4.0, help="Mbit/s for the upload times")
+    args = parser.parse_args()
+    fake_picamera.timeScale = 0
+    fake_picamera.sceneVariation = args.variation
+    profiles = {"fixed": {"resolution": [1920, 1080]},
+                "target": {"resolution": [1920, 1080], "targetBytes": args.target}}
+    agent = harness.load_camera_agent(0, "Sim Camera", profiles=profiles)
+    print(f"{args.photos} photos, target {args.target} bytes, scene variation {args.variation}, {args.bandwidth} Mbit/s")
+    print("profile   mean KB  p10 KB  p90 KB  max KB  stdev %  p90 upload s")
+    for name in profiles:
+        camera = agent.CameraController("Sim Camera")
+        camera.setResolution(name)
+        sizes = [camera.capture_photo().tell() for i in range(args.photos)]
+        mean = statistics.mean(sizes)
+        upload = percentile(sizes, 90) * 8 / (args.bandwidth * 1e6)
+        print(f"{name:8s}  {mean / 1024:7.0f}  {percentile(sizes, 10) / 1024:6.0f}  {percentile(sizes, 90) / 1024:6.0f}"
+              f"  {max(sizes) / 1024:6.0f}  {statistics.stdev(sizes) / mean * 100:7.1f}  {upload:12.2f}")
@@ -0,0 +1,88 @@
+import argparse
+import io
+import os
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import fake_picamera
+import harness
+
+# Memory held while a photo is taken and uploaded: the camera agent's old
+# upload (stream.read() and requests' files=) against the multipart body
+# that sends the capture buffer itself. Prints the peak as a multiple of the
+# JPEG's size and what the upload needs on top of the capture buffer. The
+# mock Pega server runs in its own process so that only the agent's
+# allocations are traced. test_camera_upload.py enforces the limit.
+
+RESOLUTIONS = ["low", "medium", "high"]
+
+def start_mock_server(port):
+    server = subprocess.Popen([sys.executable, os.path.join(harness.SIMULATOR_DIR, "mock_pega_server.py"),
+                               "--port", str(port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for i in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    sys.exit("mock server did not start")
+
+# camera_agent before the change.
+def capture_before(agent, camera):
+    stream = io.BytesIO()
+    camera.camera.capture(stream, format='jpeg')
+    return stream
+
+def upload_before(agent, camera, stream):
+    stream.seek(0)
+    photo = stream.read()
+    response = agent.post_with_token(f"{agent.pegaAPIUrl}/attachments/upload", files={'content': photo})
+    return response.status_code
+
+def capture_after(agent, camera):
+    return camera.capture_photo()
+
+def upload_after(agent, camera, stream):
+    return 201 if camera.upload_photo(stream, "C-1", "File", "bench.jpg") != "" else 0
+
+# Returns the peak for capture and upload, and the peak of the upload over
+# the memory held after the capture.
+def measure(capture, upload, agent, camera):
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    stream = capture(agent, camera)
+    captured, capturePeak = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    status = upload(agent, camera, stream)
+    _, uploadPeak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if status != 201:
+        sys.exit(f"upload failed with {status}")
+    return max(capturePeak, uploadPeak) - before, uploadPeak - captured, stream.tell()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Memory per photo upload: copied bytes vs streamed capture buffer")
+    parser.add_argument("--port", type=int, default=18085)
+    args = parser.parse_args()
+    server = start_mock_server(args.port)
+    try:
+        fake_picamera.timeScale = 0
+        agent = harness.load_camera_agent(args.port, "Sim Camera")
+        camera = agent.CameraController("Sim Camera")
+        # Token and connection are set up outside the measurement.
+        upload_after(agent, camera, capture_after(agent, camera))
+        print("                      before                       after")
+        print("resolution  JPEG KB   peak KB  xJPEG  upload KB    peak KB  xJPEG  upload KB")
+        for resolution in RESOLUTIONS:
+            camera.setResolution(resolution)
+            old, oldExtra, size = measure(capture_before, upload_before, agent, camera)
+            new, newExtra, size = measure(capture_after, upload_after, agent, camera)
+            print(f"{resolution:10s}  {size / 1024:7.0f}   {old / 1024:7.0f}  {old / size:5.2f}  {oldExtra / 1024:9.0f}"
+                  f"    {new / 1024:7.0f}  {new / size:5.2f}  {newExtra / 1024:9.0f}")
+    finally:
+        server.kill()
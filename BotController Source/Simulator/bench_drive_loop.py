@@ -0,0 +1,100 @@
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import fake_pybricks
+
+# Compares the control loop of drive and driveUntil before and after the
+# color sensor was read once per tick, on the stand-ins of fake_pybricks:
+# ticks per second while driving, and how far the robot got past the start
+# of the black line (drive) or the green patch (driveUntil green) before it
+# stopped. readCost stands in for the I/O of one sensor reading.
+fake_pybricks.install()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Spike Prime Embedded"))
+import RobotController as rc
+
+PATCH_AT = fake_pybricks.FLOOR[0][0]
+LINE_AT = fake_pybricks.FLOOR[1][0]
+
+# RobotController before the change: every check reads the sensor itself.
+def checkSensorsForCollisionBefore():
+    if rc.sensor.reflection() <= rc.BLACK_REFLECTION and rc.sensor.color(True) == fake_pybricks.Color.NONE:
+        rc.drive_base.stop()
+        rc.notify("linedetected")
+        return True
+    return False
+
+def checkSensorsBefore(color):
+    Color = fake_pybricks.Color
+    if color == "white" and rc.sensor.color(True) == Color.WHITE:
+        return True
+    elif color == "red" and rc.sensor.color(True) == Color.RED:
+        return True
+    elif color == "yellow" and rc.sensor.color(True) == Color.YELLOW:
+        return True
+    elif color == "blue" and rc.sensor.color(True) == Color.BLUE:
+        return True
+    elif color == "green" and rc.sensor.color(True) == Color.GREEN:
+        return True
+    return False
+
+def driveBefore(steps, ignore="false"):
+    rc.drive_base.straight(steps * rc.STEP_UNIT, wait=False)
+    while not rc.drive_base.done():
+        rc.idle()
+        if ignore != "true":
+            if checkSensorsForCollisionBefore():
+                return
+
+def driveUntilBefore(color, ignore="false"):
+    rc.drive_base.straight(100 * rc.STEP_UNIT, wait=False)
+    while not rc.drive_base.done():
+        rc.idle()
+        if checkSensorsBefore(color):
+            rc.drive_base.stop()
+            return
+        if ignore != "true":
+            if checkSensorsForCollisionBefore():
+                return
+
+def measure(run, args, target, repeat):
+    ticks = [0]
+    def tick(ms):
+        ticks[0] += 1
+        time.sleep(ms / 1000)
+    rc.idleHook = tick
+    rc.notifier = lambda message: None
+    rates = []
+    past = []
+    reads = []
+    for i in range(repeat):
+        ticks[0] = 0
+        rc.sensor.reads = 0
+        started = time.perf_counter()
+        run(*args)
+        elapsed = time.perf_counter() - started
+        rates.append(ticks[0] / elapsed)
+        past.append(rc.drive_base.stoppedAt - target)
+        reads.append(rc.sensor.reads / ticks[0])
+    return statistics.mean(rates), statistics.mean(past), max(past), statistics.mean(reads)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Hub control loop: one sensor reading per check vs one per tick")
+    parser.add_argument("--read-cost", type=float, default=1.0, help="ms per sensor reading")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--ticks", default="10,5", help="tick lengths in ms to compare")
+    args = parser.parse_args()
+    rc.drive_base = fake_pybricks.DriveBase()
+    rc.sensor.driveBase = rc.drive_base
+    rc.sensor.readCost = args.read_cost / 1000
+    print(f"read cost {args.read_cost} ms, {fake_pybricks.DRIVE_SPEED} mm/s")
+    print("loop        tick  instruction      ticks/s  reads/tick  past mean mm  past max mm")
+    for tick in [int(t) for t in args.ticks.split(",")]:
+        rc.setTick(tick)
+        for label, drive, driveUntil in (("before", driveBefore, driveUntilBefore), ("after", rc.drive, rc.driveUntil)):
+            for name, run, runArgs, target in (("drive>5", drive, (5,), LINE_AT),
+                                               ("drive>until|green", driveUntil, ("green",), PATCH_AT)):
+                rate, pastMean, pastMax, reads = measure(run, runArgs, target, args.repeat)
+                print(f"{label:8s} {tick:5d}  {name:17s} {rate:7.1f}  {reads:10.1f}  {pastMean:12.1f}  {pastMax:11.1f}")
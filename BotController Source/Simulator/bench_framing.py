@@ -0,0 +1,55 @@
+import os
+import sys
+import timeit
+
+import simulated_hub  # puts the hub sources on the path
+import Framing
+
+# Compares the tagged text protocol with binary frames: bytes on the BLE link
+# per command and reply, and the time the hub needs to receive and parse a
+# command. Times are measured on CPython and only indicate the ratio on the hub.
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Bot to Pega Bridge"))
+import hub_framing
+
+COMMANDS = [
+    ("drive", "3"),
+    ("drive", "-2|true"),
+    ("turn", "-90"),
+    ("drive", "until|blue|false"),
+    ("searchandgrab", "800|40"),
+    ("display", "Hello"),
+]
+SEQ = 123
+
+# Receive and parse the way PegaController does, byte by byte, including
+# turning numeric parameters into ints as RobotController.dispatch does.
+def receive_text(data):
+    cmd = b""
+    for i in range(len(data) - 1):
+        cmd = cmd + data[i:i + 1]
+    tag, command = str(cmd, "utf-8")[1:].split(":", 1)
+    action, params = Framing.parseText(command)
+    return action, [int(p) if p.lstrip("-").isdigit() else p for p in params]
+
+def receive_frame(data):
+    frame = bytearray(data[0:1])
+    for i in range(1, len(data)):
+        frame.append(data[i])
+    return Framing.parseFrame(frame)
+
+if __name__ == '__main__':
+    print("command                     text B  frame B  text us  frame us")
+    totalText = totalFrame = 0
+    for action, params in COMMANDS:
+        text = f"#{SEQ}:{action}>{params}\r".encode("utf-8")
+        frame = hub_framing.encode_command(action, SEQ, params)
+        totalText += len(text)
+        totalFrame += len(frame)
+        textTime = min(timeit.repeat(lambda: receive_text(text), number=20000, repeat=5)) / 20000
+        frameTime = min(timeit.repeat(lambda: receive_frame(frame), number=20000, repeat=5)) / 20000
+        print(f"{action + '>' + params:26s}  {len(text):6d}  {len(frame):7d}  {textTime * 1e6:7.2f}  {frameTime * 1e6:8.2f}")
+    reply = len(f"#{SEQ}:OK>".encode("utf-8"))
+    frameReply = len(Framing.buildReply(Framing.STATUS_OK, SEQ))
+    print(f"average command: {totalText / len(COMMANDS):.1f} B text, {totalFrame / len(COMMANDS):.1f} B framed")
+    print(f"empty OK reply: {reply} B text, {frameReply} B framed")
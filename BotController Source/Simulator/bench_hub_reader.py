@@ -0,0 +1,112 @@
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+# Compares the hub's receive loop before and after Framing.CommandReader, on
+# a stand-in for the pybricks stdin: time per byte, memory allocated per byte
+# while one instruction comes in, and memory allocated by its last byte,
+# which completes it, for growing lengths. CPython recycles small objects
+# quickly, so the time hardly differs here; the allocations are what
+# fragments the MicroPython heap on the hub. The loops append complete
+# instructions to a list that is kept between calls, so that only what the
+# loops themselves allocate is counted. Two CPython artefacts remain in the
+# reader's numbers: its position is an int object once it is past 256, and
+# the memoryview it decodes a line from takes about 180 bytes; on
+# MicroPython both are a few bytes or none.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Spike Prime Embedded"))
+import Framing
+
+class FakeBuffer:
+    def __init__(self):
+        self.data = b""
+        self.position = 0
+
+    def load(self, data):
+        self.data = data
+        self.position = 0
+
+    def waiting(self):
+        return self.position < len(self.data)
+
+    def read(self, size):
+        chunk = self.data[self.position:self.position + size]
+        self.position += len(chunk)
+        return chunk
+
+    # Like the hub's, it allocates nothing.
+    def readinto(self, buffer, size):
+        count = 0
+        while count < size and self.position < len(self.data):
+            buffer[count] = self.data[self.position]
+            self.position += 1
+            count += 1
+        return count
+
+# PegaController.readCommands before CommandReader, text lines only. Polling
+# is left out of both loops: it is the same on the hub for either, apart from
+# ipoll not building a list.
+def read_concatenating(stdin, state, items):
+    while stdin.waiting():
+        char = stdin.read(1)
+        if char == b"\r":
+            items.append(str(state[0], "utf-8"))
+            state[0] = b""
+        else:
+            state[0] = state[0] + char
+
+def read_buffered(stdin, state, items):
+    reader, received = state
+    while stdin.waiting():
+        stdin.readinto(received, 1)
+        item = reader.add(received[0])
+        if item is not None:
+            items.append(item)
+
+# BLE delivers an instruction in pieces of up to CHUNK bytes; every piece is
+# drained by one call of the receive loop.
+CHUNK = 20
+
+def measure(read, state, command, repeat):
+    stdin = FakeBuffer()
+    chunks = [command[i:i + CHUNK] for i in range(0, len(command), CHUNK)]
+    items = []
+    started = time.perf_counter()
+    for i in range(repeat):
+        for chunk in chunks:
+            stdin.load(chunk)
+            read(stdin, state, items)
+        items.clear()
+    elapsed = (time.perf_counter() - started) / repeat
+    # Memory allocated while the instruction comes in, byte by byte, so that
+    # objects freed right away are counted as well. The list gets room for
+    # the instruction beforehand.
+    allocated = []
+    items.append(None)
+    tracemalloc.start()
+    for i in range(len(command)):
+        stdin.load(command[i:i + 1])
+        items.pop()
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        read(stdin, state, items)
+        _, peak = tracemalloc.get_traced_memory()
+        allocated.append(peak - before)
+        if not items:
+            items.append(None)
+    tracemalloc.stop()
+    return elapsed, sum(allocated[:-1]) / (len(command) - 1), allocated[-1]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Hub receive loop: byte concatenation vs preallocated buffer")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+    print("         concatenating                          buffered")
+    print(" length  us/byte  bytes/byte  bytes at end    us/byte  bytes/byte  bytes at end")
+    for length in (16, 64, 128, 256, 500):
+        command = b"#12:display>" + b"x" * (length - 13) + b"\r"
+        old, oldPerByte, oldAtEnd = measure(read_concatenating, [b""], command, args.repeat)
+        new, newPerByte, newAtEnd = measure(read_buffered, (Framing.CommandReader(), bytearray(1)), command, args.repeat)
+        print(f"{length:7d}  {old / length * 1e6:7.2f}  {oldPerByte:10.1f}  {oldAtEnd:12d}"
+              f"    {new / length * 1e6:7.2f}  {newPerByte:10.1f}  {newAtEnd:12d}")
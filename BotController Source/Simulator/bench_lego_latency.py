@@ -0,0 +1,43 @@
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+import simulated_hub
+
+# Measures how long LegoController.execute() takes for a command the hub
+# answers almost immediately, i.e. the overhead the bridge adds on top of
+# the BLE link and the hub itself.
+
+BRIDGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Bot to Pega Bridge")
+sys.path.insert(0, BRIDGE_DIR)
+import lego_controller
+
+async def run(count, linkLatency, fragment, mtu, withoutResponse, size):
+    simulated_hub.install(lego_controller)
+    simulated_hub.add_hub(simulated_hub.SimulatedHub("Bench Hub", linkLatency=linkLatency, fragment=fragment,
+                                                     mtu=mtu, writeWithoutResponse=withoutResponse))
+    lego = lego_controller.LegoController("Bench Hub", lambda: None)
+    await lego.connect()
+    latencies = []
+    for i in range(count):
+        started = time.perf_counter()
+        await lego.execute("display", str(i).rjust(size, "0"))
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Command round trip of LegoController against a simulated hub")
+    parser.add_argument("--commands", type=int, default=50)
+    parser.add_argument("--link-latency", type=float, default=0.01, help="one-way BLE latency in seconds")
+    parser.add_argument("--fragment", type=int, default=0, help="cut notifications into random pieces of at most this many bytes")
+    parser.add_argument("--mtu", type=int, default=158)
+    parser.add_argument("--with-response", action="store_true", help="hub does not allow write without response")
+    parser.add_argument("--size", type=int, default=1, help="length of the display parameter in bytes")
+    args = parser.parse_args()
+    latencies = asyncio.run(run(args.commands, args.link_latency, args.fragment, args.mtu, not args.with_response, args.size))
+    p = statistics.quantiles(latencies, n=100)
+    print(f"{args.commands} commands, link latency {args.link_latency * 1000:.0f} ms, MTU {args.mtu}")
+    print(f"mean {statistics.mean(latencies) * 1000:.1f} ms  p50 {p[49] * 1000:.1f} ms  p99 {p[98] * 1000:.1f} ms")
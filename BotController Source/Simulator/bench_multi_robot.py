@@ -0,0 +1,82 @@
+import argparse
+import asyncio
+import concurrent.futures
+import os
+import statistics
+import time
+
+import harness
+from mock_pega_server import start_server
+
+# Runs the bridge's robot tasks for 1..N robots in one process against the
+# mock Pega queue, with hubs replaced by a fixed execution delay, and prints
+# the end-to-end latency per instruction. It should stay flat as robots are
+# added, since the robots only share the connection pool.
+
+class TimedLego:
+    motion = 0.2
+
+    def __init__(self, name, onReady, **kwargs):
+        self.name = name
+        self.onReady = onReady
+        self.response = ""
+
+    async def connect(self):
+        self.onReady()
+
+    async def execute(self, action, parameters, timeout=None):
+        await asyncio.sleep(self.motion)
+        self.response = ""
+
+def load_bridge(port, robots):
+    bridge = harness.load_bridge(port, robots)
+    bridge.LegoController = TimedLego
+    return bridge
+
+async def drive(queue, robot, count, executor):
+    latencies = []
+    for i in range(count):
+        uid = queue.add(robot, "drive", "1")
+        result = await asyncio.get_running_loop().run_in_executor(executor, queue.wait_for, uid, 30)
+        if result is None:
+            raise RuntimeError(f"{robot}: instruction {uid} was not completed within 30 s")
+        latencies.append(result["completed"] - result["created"])
+    return latencies
+
+async def run(bridge, queue, robots, count):
+    bridge.connectLock = asyncio.Lock()
+    tasks = [asyncio.create_task(bridge.run_robot(r)) for r in robots]
+    await asyncio.sleep(1.2)  # run_robot settles for a second after connecting
+    started = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(robots)) as executor:
+        latencies = await asyncio.gather(*(drive(queue, r, count, executor) for r in robots))
+    elapsed = time.monotonic() - started
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return [l for robot in latencies for l in robot], elapsed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Per-robot latency of the bridge as robots are added")
+    parser.add_argument("--max-robots", type=int, default=8)
+    parser.add_argument("--instructions", type=int, default=20, help="instructions per robot")
+    parser.add_argument("--motion", type=float, default=0.2, help="simulated hub execution time in seconds")
+    parser.add_argument("--port", type=int, default=18080)
+    args = parser.parse_args()
+
+    TimedLego.motion = args.motion
+    server = start_server(args.port)
+    allRobots = [f"Bench {i + 1}" for i in range(args.max_robots)]
+    bridge = load_bridge(args.port, allRobots)
+    print(f"motion {args.motion * 1000:.0f} ms, {args.instructions} instructions per robot")
+    print("robots  p50 ms  p99 ms  instr/s")
+    n = 1
+    while n <= args.max_robots:
+        # Fresh names per round: a cancelled long poll from the previous round
+        # must not lease an instruction meant for this one.
+        robots = [f"Bench {n}-{i + 1}" for i in range(n)]
+        latencies, elapsed = asyncio.run(run(bridge, server.queue, robots, args.instructions))
+        p = statistics.quantiles(latencies, n=100)
+        print(f"{n:6d}  {p[49] * 1000:6.1f}  {p[98] * 1000:6.1f}  {len(latencies) / elapsed:7.1f}")
+        n *= 2
+    server.shutdown()
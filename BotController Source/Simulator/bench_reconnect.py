@@ -0,0 +1,56 @@
+import argparse
+import asyncio
+import collections
+import os
+import statistics
+import sys
+import tempfile
+
+import simulated_hub
+
+# Drops the BLE link of a simulated hub while instructions are running and
+# measures how long LegoController takes to reconnect, with and without the
+# cached hub address. Instructions in flight during a drop must fail with a
+# "disconnected" event and later ones must succeed again.
+
+BRIDGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Bot to Pega Bridge")
+sys.path.insert(0, BRIDGE_DIR)
+import lego_controller
+
+async def drive_forever(lego, outcomes):
+    while True:
+        try:
+            await lego.execute("drive", "1", timeout=30)
+            outcomes["ok"] += 1
+        except lego_controller.LegoControllerException as e:
+            outcomes[e.type] += 1
+
+async def run(name, addressCache, drops, outage, interval):
+    hub = simulated_hub.add_hub(simulated_hub.SimulatedHub(name, timeScale=0.5))
+    lego = lego_controller.LegoController(name, lambda: None, addressCache=addressCache, reconnectMaxDelay=2)
+    await lego.connect()
+    outcomes = collections.Counter()
+    driver = asyncio.create_task(drive_forever(lego, outcomes))
+    for i in range(drops):
+        await asyncio.sleep(interval)
+        hub.drop_link(outage)
+        while lego.reconnects <= i:
+            await asyncio.sleep(0.05)
+    await asyncio.sleep(interval)
+    driver.cancel()
+    await lego.disconnect()
+    return list(lego.reconnectTimes), outcomes
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time-to-reconnect of LegoController with injected disconnects")
+    parser.add_argument("--drops", type=int, default=5)
+    parser.add_argument("--outage", type=float, default=1.0, help="seconds the hub stays out of reach per drop")
+    parser.add_argument("--interval", type=float, default=2.0, help="seconds between reconnect and the next drop")
+    args = parser.parse_args()
+
+    simulated_hub.install(lego_controller)
+    cache = os.path.join(tempfile.mkdtemp(), "hub_addresses.json")
+    print(f"{args.drops} drops, hub out of reach for {args.outage:.1f} s each")
+    for label, name, addressCache in (("scan", "Scan Hub", None), ("cached address", "Cached Hub", cache)):
+        times, outcomes = asyncio.run(run(name, addressCache, args.drops, args.outage, args.interval))
+        print(f"{label:15s} reconnect mean {statistics.mean(times):.2f} s  max {max(times):.2f} s  instructions {dict(outcomes)}")
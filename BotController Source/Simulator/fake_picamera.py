@@ -0,0 +1,60 @@
+import random
+import sys
+import time
+import types
+
+# Stand-in for the picamera module on a Raspberry Pi, so camera_agent.py can
+# run anywhere. Captures take about as long as on a Pi camera and produce
+# JPEG-sized dummy data.
+
+STILL_CAPTURE_TIME = 0.6 # seconds through the still port, including mode switch
+VIDEO_CAPTURE_TIME = 0.05 # seconds per frame through the video port
+BYTES_PER_PIXEL = 0.12 # typical JPEG size at the default quality
+BUFFER_SIZE = 65536 # bytes per write to the output
+GRAYSCALE_SIZE = 0.8 # JPEG size of a grayscale photo relative to color
+
+timeScale = 1.0
+# How much the detail in the scene, and with it the JPEG size, may change
+# from one photo to the next (0.2 = up to 20 %), as a random walk.
+sceneVariation = 0.0
+
+# JPEG size relative to quality 85: it grows slowly at low qualities and
+# steeply towards 100 (about 0.3 at 50, 2 at 95).
+def quality_factor(quality):
+    return (100 + quality) / (105 - quality) / (185 / 20)
+
+class PiCamera:
+    def __init__(self, *args, **kwargs):
+        self.resolution = (1920, 1080)
+        self.color_effects = None
+        self.zoom = (0.0, 0.0, 1.0, 1.0)
+        self.captures = 0
+        self.scene = 1.0
+        self.random = random.Random(1)
+
+    # Writes the frame in pieces, as picamera does from its encoder buffers.
+    def capture(self, output, format=None, use_video_port=False, quality=85, **kwargs):
+        time.sleep((VIDEO_CAPTURE_TIME if use_video_port else STILL_CAPTURE_TIME) * timeScale)
+        self.captures += 1
+        width, height = self.resolution
+        self.scene = min(2.0, max(0.5, self.scene * (1 + self.random.uniform(-sceneVariation, sceneVariation))))
+        size = int(width * height * BYTES_PER_PIXEL * quality_factor(quality) * self.scene)
+        if self.color_effects is not None:
+            size = int(size * GRAYSCALE_SIZE)
+        piece = bytes(BUFFER_SIZE)
+        output.write(b"\xff\xd8\xff\xe0")
+        for start in range(4, size - 2, BUFFER_SIZE):
+            output.write(piece[:min(BUFFER_SIZE, size - 2 - start)])
+        output.write(b"\xff\xd9")
+
+    def capture_sequence(self, outputs, format=None, use_video_port=False, quality=85, **kwargs):
+        for output in outputs:
+            self.capture(output, format, use_video_port, quality)
+
+    def close(self):
+        pass
+
+def install():
+    module = types.ModuleType("picamera")
+    module.PiCamera = PiCamera
+    sys.modules["picamera"] = module
@@ -0,0 +1,106 @@
+import sys
+import time
+import types
+
+# Stand-in for the pybricks modules on the SPIKE Prime hub, so that
+# RobotController.py can be imported on a PC. The drive base moves at a
+# constant speed in real time, and the color sensor looks at a floor with a
+# colored patch and a black line, taking readCost seconds per reading like
+# the I/O of the real sensor.
+
+DRIVE_SPEED = 200 # mm/s, pybricks DriveBase default straight speed
+
+class Anything:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        return Anything()
+
+    def __call__(self, *args, **kwargs):
+        return Anything()
+
+class Color:
+    NONE = "none"
+    BLACK = "black"
+    WHITE = "white"
+    RED = "red"
+    YELLOW = "yellow"
+    BLUE = "blue"
+    GREEN = "green"
+
+class DriveBase:
+    def __init__(self, *args, **kwargs):
+        self.startedAt = None
+        self.target = 0
+        self.stoppedAt = 0
+
+    def straight(self, distance, wait=True):
+        self.startedAt = time.perf_counter()
+        self.target = distance
+        if wait:
+            time.sleep(abs(distance) / DRIVE_SPEED)
+            self.stop()
+
+    def distance(self):
+        if self.startedAt is None:
+            return self.stoppedAt
+        return min(DRIVE_SPEED * (time.perf_counter() - self.startedAt), self.target)
+
+    def done(self):
+        return self.startedAt is None or self.distance() >= self.target
+
+    def stop(self):
+        self.stoppedAt = self.distance()
+        self.startedAt = None
+
+    def turn(self, *args, **kwargs):
+        pass
+
+# Patches on the floor as (start mm, end mm, color, reflection); white
+# floor with a reflection of 70 elsewhere.
+FLOOR = [
+    (150, 190, Color.GREEN, 30),
+    (300, 318, Color.NONE, 8),
+]
+
+class ColorSensor:
+    def __init__(self, *args, **kwargs):
+        self.driveBase = None
+        self.readCost = 0.0
+        self.reads = 0
+
+    def read(self):
+        self.reads += 1
+        started = time.perf_counter()
+        while time.perf_counter() - started < self.readCost:
+            pass
+        position = self.driveBase.distance()
+        for start, end, color, reflection in FLOOR:
+            if start <= position < end:
+                return color, reflection
+        return Color.WHITE, 70
+
+    def color(self, surface=True):
+        return self.read()[0]
+
+    def reflection(self):
+        return self.read()[1]
+
+def install():
+    modules = {
+        "pybricks": {},
+        "pybricks.hubs": {"PrimeHub": Anything},
+        "pybricks.pupdevices": {"Motor": Anything, "ColorSensor": ColorSensor,
+                                "UltrasonicSensor": Anything, "ForceSensor": Anything},
+        "pybricks.parameters": {"Button": Anything(), "Color": Color, "Direction": Anything(),
+                                "Port": Anything(), "Side": Anything(), "Stop": Anything()},
+        "pybricks.robotics": {"DriveBase": DriveBase},
+        "pybricks.tools": {"wait": lambda ms: time.sleep(ms / 1000), "StopWatch": Anything},
+        "usys": {"stdin": sys.stdin, "stdout": sys.stdout},
+    }
+    for name, attributes in modules.items():
+        module = types.ModuleType(name)
+        for key, value in attributes.items():
+            setattr(module, key, value)
+        sys.modules[name] = module
@@ -0,0 +1,60 @@
+import json
+import os
+import sys
+import tempfile
+
+# Loads main.py and camera_agent.py as they are, each with its own
+# settings.yaml pointing at the mock Pega server.
+
+SIMULATOR_DIR = os.path.dirname(os.path.abspath(__file__))
+BRIDGE_DIR = os.path.join(SIMULATOR_DIR, "..", "Bot to Pega Bridge")
+CAMERA_DIR = os.path.join(SIMULATOR_DIR, "..", "Camera Embedded")
+
+def base_url(port):
+    return f"http://127.0.0.1:{port}/prweb/api/PegaBotController/1/"
+
+def api_url(port):
+    return f"http://127.0.0.1:{port}/prweb/api/application/v2"
+
+def oauth_url(port):
+    return f"http://127.0.0.1:{port}/prweb/PRRestService/oauth2/v1/token"
+
+def write_settings(settings):
+    workdir = tempfile.mkdtemp()
+    with open(os.path.join(workdir, "settings.yaml"), "w") as f:
+        for key, value in settings.items():
+            if isinstance(value, str):
+                value = '"' + value + '"'
+            elif isinstance(value, bool):
+                value = "true" if value else "false"
+            elif isinstance(value, (list, dict)):
+                value = json.dumps(value)
+            f.write(f"{key}: {value}\n")
+    return workdir
+
+# Both programs read settings.yaml from the working directory on import.
+def load(directory, module, settings):
+    cwd = os.getcwd()
+    os.chdir(write_settings(settings))
+    sys.path.insert(0, directory)
+    try:
+        return __import__(module)
+    finally:
+        sys.path.remove(directory)
+        os.chdir(cwd)
+
+def load_bridge(port, robots, **settings):
+    values = {"robotId": robots[0], "robots": robots, "baseUrl": base_url(port),
+              "userName": "bench", "password": "bench", "longPoll": 2}
+    values.update(settings)
+    return load(BRIDGE_DIR, "main", values)
+
+def load_camera_agent(port, robot, **settings):
+    import fake_picamera
+    fake_picamera.install()
+    values = {"robotId": robot, "baseUrl": base_url(port), "userName": "bench", "password": "bench",
+              "pegaAPIUrl": api_url(port), "pegaAPIOAuthUrl": oauth_url(port),
+              "pegaAPIClient": "bench", "pegaAPISecret": "bench",
+              "attachment_category": "File", "attachment_filename": "legocam.jpg", "longPoll": 2}
+    values.update(settings)
+    return load(CAMERA_DIR, "camera_agent", values)
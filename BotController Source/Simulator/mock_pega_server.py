@@ -0,0 +1,285 @@
+import argparse
+import email.parser
+import itertools
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+# Local stand-in for the PegaBotController REST API, so the bridge and the
+# camera agent can be run without a Pega instance. It also answers the parts
+# of the Pega application API and the OAuth token endpoint that the camera
+# agent uses.
+# Point baseUrl at http://localhost:8080/prweb/api/PegaBotController/1/
+
+NEXT_PATH = re.compile(r".*/robot/([^/]+)/instructions/next$")
+INSTRUCTION_PATH = re.compile(r".*/robot/([^/]+)/instructions/([^/]+)$")
+EVENT_PATH = re.compile(r".*/robot/([^/]+)/instructions/([^/]+)/event$")
+QUEUE_PATH = re.compile(r".*/robot/([^/]+)/instructions$")
+RESULTS_PATH = re.compile(r".*/robot/([^/]+)/results$")
+UPLOAD_PATH = re.compile(r".*/attachments/upload$")
+ATTACH_PATH = re.compile(r".*/cases/([^/]+)/attachments$")
+TOKEN_PATH = re.compile(r".*/oauth2/v1/token$")
+
+class MockPegaQueue:
+    def __init__(self, longPoll=True, lease=30):
+        self.longPoll = longPoll
+        self.lease = lease
+        self.instructions = {}
+        self.order = {}
+        self.events = []
+        self.requests = 0
+        # Access tokens and when they expire (time.monotonic()).
+        self.tokens = {}
+        self.tokenRequests = 0
+        self.uploads = []
+        self.attachments = []
+        # While set, results and events are answered with this status, to
+        # simulate Pega being unreachable for the bridge's reports.
+        self.resultStatus = None
+        self.ids = itertools.count(1)
+        self.condition = threading.Condition()
+
+    def add(self, robot, action, data, uid=None):
+        with self.condition:
+            if uid is None:
+                uid = f"I-{next(self.ids)}"
+            self.instructions[uid] = {
+                "robot": robot, "UID": uid, "Action": action, "Data": data,
+                "state": "pending", "leased": 0, "deliveries": 0,
+                "created": time.monotonic(), "completed": None, "result": None,
+            }
+            self.order.setdefault(robot, []).append(uid)
+            self.condition.notify_all()
+            return uid
+
+    def available(self, robot):
+        now = time.monotonic()
+        for uid in self.order.get(robot, []):
+            instruction = self.instructions[uid]
+            if instruction["state"] == "pending":
+                return instruction
+            # Like Pega, an instruction without a result is handed out again
+            # once its lease has run out.
+            if instruction["state"] == "leased" and now - instruction["leased"] > self.lease:
+                return instruction
+        return None
+
+    def next(self, robot, wait=0):
+        deadline = time.monotonic() + wait
+        with self.condition:
+            self.requests += 1
+            while True:
+                instruction = self.available(robot)
+                if instruction is not None:
+                    instruction["state"] = "leased"
+                    instruction["leased"] = time.monotonic()
+                    instruction["deliveries"] += 1
+                    return {k: instruction[k] for k in ("UID", "Action", "Data")}
+                remaining = deadline - time.monotonic()
+                if not self.longPoll or remaining <= 0:
+                    return None
+                self.condition.wait(min(remaining, 0.5))
+
+    def complete(self, uid, state, result):
+        with self.condition:
+            self.requests += 1
+            instruction = self.instructions.get(uid)
+            if instruction is None:
+                return False
+            if instruction["completed"] is None:
+                instruction["completed"] = time.monotonic()
+            instruction["state"] = state
+            instruction["result"] = result
+            self.condition.notify_all()
+            return True
+
+    def issue_token(self, lifetime):
+        with self.condition:
+            self.tokenRequests += 1
+            token = f"T-{next(self.ids)}"
+            self.tokens[token] = time.monotonic() + lifetime
+            return token
+
+    # Invalidates every token handed out so far, like a restart of Pega; the
+    # next call with one of them is answered with 401.
+    def revoke_tokens(self):
+        with self.condition:
+            self.tokens.clear()
+
+    def authorized(self, header):
+        if header is None or not header.startswith("Bearer "):
+            return False
+        with self.condition:
+            return self.tokens.get(header[7:], 0) > time.monotonic()
+
+    def results(self, robot):
+        with self.condition:
+            return [dict(self.instructions[uid]) for uid in self.order.get(robot, [])]
+
+    def wait_for(self, uid, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.instructions[uid]["state"] in ("pending", "leased"):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(min(remaining, 0.5))
+            return dict(self.instructions[uid])
+
+    def wait_until_done(self, robot, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while any(self.instructions[uid]["state"] in ("pending", "leased") for uid in self.order.get(robot, [])):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(min(remaining, 0.5))
+            return True
+
+class MockPegaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def body_bytes(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            data = b""
+            while True:
+                size = int(self.rfile.readline().strip().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return data
+                data += self.rfile.read(size)
+                self.rfile.readline()
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def body(self):
+        return self.body_bytes().decode("utf-8")
+
+    # The file parts of a multipart/form-data body as (name, filename, data).
+    def form_files(self, body):
+        header = f"Content-Type: {self.headers.get('Content-Type', '')}\r\n\r\n".encode("utf-8")
+        message = email.parser.BytesParser().parsebytes(header + body)
+        if not message.is_multipart():
+            return []
+        return [(part.get_param("name", header="Content-Disposition"), part.get_filename(), part.get_payload(decode=True))
+                for part in message.get_payload() if part.get_filename() is not None]
+
+    def reply(self, status, data=None):
+        payload = b"" if data is None else json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        if payload:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        queue = self.server.queue
+        path = unquote(url.path)
+        match = NEXT_PATH.match(path)
+        if match:
+            wait = float(parse_qs(url.query).get("wait", ["0"])[0])
+            instruction = queue.next(match.group(1), wait)
+            if instruction is None:
+                self.reply(204)
+            else:
+                self.reply(200, instruction)
+            return
+        match = RESULTS_PATH.match(path)
+        if match:
+            self.reply(200, queue.results(match.group(1)))
+            return
+        self.reply(404)
+
+    def do_PUT(self):
+        match = INSTRUCTION_PATH.match(unquote(urlparse(self.path).path))
+        if self.server.queue.resultStatus is not None:
+            self.body()
+            self.reply(self.server.queue.resultStatus)
+        elif match and self.server.queue.complete(match.group(2), "done", self.body()):
+            self.reply(202)
+        else:
+            self.reply(404)
+
+    def do_POST(self):
+        path = unquote(urlparse(self.path).path)
+        queue = self.server.queue
+        if TOKEN_PATH.match(path):
+            self.body()
+            self.reply(200, {"access_token": queue.issue_token(self.server.tokenLifetime), "token_type": "bearer",
+                             "expires_in": self.server.tokenLifetime})
+            return
+        if UPLOAD_PATH.match(path) or ATTACH_PATH.match(path):
+            body = self.body_bytes()
+            time.sleep(self.server.apiLatency)
+            if not queue.authorized(self.headers.get("Authorization")):
+                self.reply(401)
+                return
+            match = ATTACH_PATH.match(path)
+            if match:
+                queue.attachments.append((match.group(1), json.loads(body or b"{}")))
+                self.reply(201)
+            else:
+                files = self.form_files(body)
+                if not files:
+                    self.reply(400)
+                    return
+                uid = f"ATT-{next(queue.ids)}"
+                queue.uploads.append((uid, sum(len(data) for name, filename, data in files)))
+                self.reply(201, {"ID": uid})
+            return
+        match = EVENT_PATH.match(path)
+        if match and queue.resultStatus is not None:
+            self.body()
+            self.reply(queue.resultStatus)
+            return
+        if match:
+            event = json.loads(self.body() or "{}")
+            queue.events.append((match.group(2), event))
+            if queue.complete(match.group(2), "event", event):
+                self.reply(200)
+            else:
+                self.reply(404)
+            return
+        match = QUEUE_PATH.match(path)
+        if match:
+            data = json.loads(self.body() or "{}")
+            uid = queue.add(match.group(1), data["Action"], data.get("Data", ""), data.get("UID"))
+            self.reply(201, {"UID": uid})
+            return
+        self.reply(404)
+
+def start_server(port=8080, longPoll=True, lease=30, verbose=False, tokenLifetime=3600, apiLatency=0):
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockPegaHandler)
+    server.daemon_threads = True
+    server.queue = MockPegaQueue(longPoll=longPoll, lease=lease)
+    server.verbose = verbose
+    server.tokenLifetime = tokenLifetime
+    # Seconds added to every upload and attachment call, like a Pega
+    # instance across the internet.
+    server.apiLatency = apiLatency
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local stand-in for the PegaBotController queue API")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--no-long-poll", action="store_true", help="answer 204 immediately and ignore 'wait'")
+    parser.add_argument("--lease", type=float, default=30, help="seconds before an unanswered instruction is handed out again")
+    args = parser.parse_args()
+    server = start_server(args.port, not args.no_long_poll, args.lease, verbose=True)
+    print(f"Mock Pega queue on http://127.0.0.1:{args.port}/prweb/api/PegaBotController/1/")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
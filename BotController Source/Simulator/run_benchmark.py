@@ -0,0 +1,135 @@
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import threading
+import time
+
+import fake_picamera
+import harness
+import simulated_hub
+from mock_pega_server import start_server
+
+# End-to-end benchmark without Pega, hubs or a camera: the mock Pega server
+# queues instructions, main.py drives simulated hubs over the fake bleak
+# client and camera_agent.py takes photos with the fake picamera. Both
+# programs run unchanged. Each robot keeps 'depth' instructions queued; the
+# latency of an instruction is from queueing until its result is in Pega.
+
+ROBOT_INSTRUCTIONS = [
+    ("drive", "2"),
+    ("turn", "90"),
+    ("display", "Hi"),
+    ("drive", "-1"),
+    ("turn", "-90"),
+]
+# The same route as one instruction for hubs that run scripts.
+ROBOT_SCRIPT = [("script", "|".join(action + "," + data for action, data in ROBOT_INSTRUCTIONS))]
+
+def percentile(values, p):
+    if len(values) < 2:
+        return values[0] if values else 0
+    return statistics.quantiles(values, n=100)[p - 1]
+
+def drive_queue(queue, robot, instructions, count, depth, latencies, outcomes):
+    outstanding = []
+    sent = 0
+    while sent < count or outstanding:
+        while sent < count and len(outstanding) < depth:
+            action, data = instructions[sent % len(instructions)]
+            outstanding.append(queue.add(robot, action, data))
+            sent += 1
+        result = queue.wait_for(outstanding.pop(0), 120)
+        if result is None:
+            outcomes["timeout"] = outcomes.get("timeout", 0) + 1
+            continue
+        latencies.append(result["completed"] - result["created"])
+        outcomes[result["state"]] = outcomes.get(result["state"], 0) + 1
+
+def measure(queue, robots, instructions, count, depth):
+    latencies = []
+    outcomes = {}
+    threads = [threading.Thread(target=drive_queue, args=(queue, r, instructions, count, depth, latencies, outcomes))
+               for r in robots]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, outcomes, time.monotonic() - started
+
+def report(label, latencies, outcomes, elapsed, steps=1):
+    if not latencies:
+        print(f"{label:8s} no instructions completed {outcomes}")
+        return
+    print(f"{label:8s} {len(latencies):5d} instr  {len(latencies) / elapsed:6.2f} instr/s  "
+          f"{len(latencies) * steps / elapsed:6.2f} moves/s  "
+          f"p50 {percentile(latencies, 50) * 1000:7.1f} ms  p99 {percentile(latencies, 99) * 1000:7.1f} ms  {outcomes}")
+
+def warm_up(queue, robot, action, data):
+    uid = queue.add(robot, action, data)
+    if queue.wait_for(uid, 60) is None:
+        sys.exit(f"{robot} did not come up")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of the bridge and the camera agent")
+    parser.add_argument("--robots", type=int, default=1)
+    parser.add_argument("--instructions", type=int, default=20, help="instructions per robot")
+    parser.add_argument("--photos", type=int, default=5, help="photo instructions for the camera (0 to skip)")
+    parser.add_argument("--depth", type=int, default=1, help="instructions kept queued per robot")
+    parser.add_argument("--time-scale", type=float, default=0.2, help="factor on hub motion and camera times")
+    parser.add_argument("--collision-rate", type=float, default=0.0)
+    parser.add_argument("--link-latency", type=float, default=0.01)
+    parser.add_argument("--pipeline", action="store_true")
+    parser.add_argument("--binary", action="store_true")
+    parser.add_argument("--script", action="store_true", help="send each five-move route as one script instruction")
+    parser.add_argument("--burst", type=int, default=0, help="take this many frames per camera instruction with burst")
+    parser.add_argument("--token-lifetime", type=float, default=3600, help="seconds an OAuth token of the mock server is valid")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="seconds the mock server adds to uploads and attachments")
+    parser.add_argument("--port", type=int, default=18081)
+    args = parser.parse_args()
+
+    server = start_server(args.port, tokenLifetime=args.token_lifetime, apiLatency=args.api_latency)
+    queue = server.queue
+    robots = [f"Sim Robot {i + 1}" for i in range(args.robots)]
+
+    bridge = harness.load_bridge(args.port, robots, pipeline=args.pipeline, binaryFraming=args.binary, hubTimeout=60)
+    simulated_hub.install(sys.modules["lego_controller"])
+    for robot in robots:
+        simulated_hub.add_hub(simulated_hub.SimulatedHub(robot, timeScale=args.time_scale,
+                                                         linkLatency=args.link_latency,
+                                                         collisionRate=args.collision_rate, seed=1))
+    threading.Thread(target=asyncio.run, args=(bridge.main(robots),), daemon=True).start()
+    for robot in robots:
+        warm_up(queue, robot, "display", "ready")
+
+    print(f"{args.robots} robot(s), {args.instructions} instructions each, depth {args.depth}, "
+          f"time scale {args.time_scale}, pipeline {args.pipeline}, binary {args.binary}, script {args.script}")
+    if args.script:
+        count = max(1, args.instructions // len(ROBOT_INSTRUCTIONS))
+        latencies, outcomes, elapsed = measure(queue, robots, ROBOT_SCRIPT, count, args.depth)
+        report("bridge", latencies, outcomes, elapsed, len(ROBOT_INSTRUCTIONS))
+    else:
+        latencies, outcomes, elapsed = measure(queue, robots, ROBOT_INSTRUCTIONS, args.instructions, args.depth)
+        report("bridge", latencies, outcomes, elapsed)
+
+    if args.photos > 0:
+        fake_picamera.timeScale = args.time_scale
+        camera = harness.load_camera_agent(args.port, "Sim Camera", pipeline=args.pipeline)
+        threading.Thread(target=camera.main, args=("Sim Camera",), daemon=True).start()
+        photo = [("photo", "C-1|File|low|sim.jpg")]
+        warm_up(queue, "Sim Camera", *photo[0])
+        if args.burst:
+            burst = [("burst", f"C-1|File|low|sim.jpg|{args.burst}")]
+            count = max(1, args.photos // args.burst)
+            latencies, outcomes, elapsed = measure(queue, ["Sim Camera"], burst, count, args.depth)
+            report("camera", latencies, outcomes, elapsed, args.burst)
+        else:
+            latencies, outcomes, elapsed = measure(queue, ["Sim Camera"], photo, args.photos, args.depth)
+            report("camera", latencies, outcomes, elapsed)
+        print(f"camera   {queue.tokenRequests} token requests")
+    server.shutdown()
+    # The bridge and the camera agent poll forever; leave without waiting.
+    sys.stdout.flush()
+    os._exit(0)
@@ -0,0 +1,326 @@
+import asyncio
+import os
+import random
+import sys
+
+# A SPIKE Prime hub running PegaController.py, as seen from the bridge: it
+# takes "action>param|param\r" commands or binary frames one at a time, spends
+# a realistic time on each and answers with "OK>response" (or "linedetected"
+# first on a collision), through stand-ins for the bleak classes used by
+# lego_controller. The hub's own instruction parser is reused as is.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Spike Prime Embedded"))
+import Framing
+
+UART_SERVICE_UUID = "6E400001-B5A3-F393-E0A9-E50E24DCCA9E"
+UART_RX_CHAR_UUID = "6E400002-B5A3-F393-E0A9-E50E24DCCA9E"
+UART_TX_CHAR_UUID = "6E400003-B5A3-F393-E0A9-E50E24DCCA9E"
+
+STEP_UNIT = 100 # mm, as in RobotController
+DRIVE_SPEED = 200 # mm/s, pybricks DriveBase default straight speed
+TURN_RATE = 180 # deg/s
+SWEEP_RATE = 60 # deg/s, as in RobotController
+SEARCH_ANGLE = 40 # degrees to either side, as in RobotController
+GAMEOVER_SOUND = 2.0 # seconds of sound_gameover after a collision
+SCAN_TIME = 2.0 # seconds until a scan by name finds the hub
+CONNECT_TIME = 0.3 # seconds to connect to a known address
+ATT_HEADER = 3
+QUERY_ACTIONS = ("display", "sensors", "version")
+
+class SimulatedHub:
+    def __init__(self, name, timeScale=1.0, linkLatency=0.01, collisionRate=0.0, seed=None, protocol=5, fragment=0, mtu=158, writeWithoutResponse=True):
+        self.name = name
+        # Pybricks hubs negotiate an MTU of 158 bytes; 23 is the BLE minimum.
+        self.mtu = mtu
+        self.writeWithoutResponse = writeWithoutResponse
+        self.protocol = protocol
+        # With fragment > 0 the notification stream is cut into random pieces
+        # of at most that many bytes, and replies that are close together are
+        # coalesced, as can happen on a real BLE link.
+        self.fragment = fragment
+        self.outgoing = b""
+        self.reachable = True
+        self.running = False
+        self.client = None
+        self.address = "SIM:" + name
+        self.timeScale = timeScale
+        self.linkLatency = linkLatency
+        self.collisionRate = collisionRate
+        self.random = random.Random(seed)
+        self.notify = None
+        self.reader = Framing.CommandReader()
+        self.busyUntil = 0
+        self.commands = []
+
+    def duration(self, action, params):
+        try:
+            if action == "drive":
+                if params[0] == "until":
+                    return 3.0
+                return abs(int(params[0])) * STEP_UNIT / DRIVE_SPEED
+            if action == "turn":
+                return abs(int(params[0])) / TURN_RATE
+            if action == "searchandgrab":
+                return 10.0
+            if action == "search":
+                angle = int(params[1]) if len(params) > 1 and params[1] else SEARCH_ANGLE
+                return 2 * angle / TURN_RATE + 2 * angle / SWEEP_RATE
+            if action == "releasegrabber":
+                return 3.5
+            if action == "dance":
+                return 8.0
+        except (IndexError, ValueError):
+            pass
+        return 0.005
+
+    def reply(self, data, delay):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        loop = asyncio.get_running_loop()
+        loop.call_later(delay + self.linkLatency, self.deliver, bytes(data))
+
+    def text(self, message):
+        if self.protocol >= 4:
+            return message + "\n"
+        return message
+
+    def deliver(self, data):
+        if self.fragment <= 0:
+            if self.notify is not None:
+                self.notify(UART_TX_CHAR_UUID, bytearray(data))
+            return
+        if self.outgoing == b"":
+            asyncio.get_running_loop().call_later(0.002, self.flush)
+        self.outgoing += data
+
+    def flush(self):
+        while self.outgoing:
+            size = self.random.randint(1, self.fragment)
+            chunk, self.outgoing = self.outgoing[:size], self.outgoing[size:]
+            if self.notify is not None:
+                self.notify(UART_TX_CHAR_UUID, bytearray(chunk))
+
+    def hello(self):
+        # Hello always fits one notification; the bridge learns from it
+        # whether replies are newline-terminated.
+        data = bytearray(self.text("Hello").encode("utf-8"))
+        asyncio.get_running_loop().call_later(0.05 + self.linkLatency, self.notify, UART_TX_CHAR_UUID, data)
+
+    def handle(self, cmd):
+        self.commands.append(cmd)
+        prefix = ""
+        # A protocol 1 hub takes the tag as part of an unknown action name.
+        if cmd.startswith("#") and self.protocol >= 2:
+            tag, cmd = cmd[1:].split(":", 1)
+            prefix = "#" + tag + ":"
+        action, params = Framing.parseText(cmd)
+        if params == [""]:
+            params = []
+        def respond(status, payload, delay):
+            if status == Framing.STATUS_LINEDETECTED:
+                text = "linedetected"
+            elif status == Framing.STATUS_ERROR:
+                text = "error>" + payload
+            else:
+                text = "OK>" + payload
+            self.reply(self.text(prefix + text), delay)
+        self.run(action, params, prefix != "", respond)
+
+    def handle_frame(self, frame):
+        self.commands.append(bytes(frame))
+        try:
+            action, seq, params = Framing.parseFrame(frame)
+        except ValueError as e:
+            self.reply(Framing.buildReply(Framing.STATUS_ERROR, frame[2], str(e)), 0)
+            return
+        def respond(status, payload, delay):
+            self.reply(Framing.buildReply(status, seq, payload), delay)
+        self.run(action, [str(p) for p in params], True, respond)
+
+    def run(self, action, params, tagged, respond):
+        loop = asyncio.get_running_loop()
+        if action not in Framing.OPCODES.values():
+            respond(Framing.STATUS_ERROR, "unknown action " + action, 0.005 * self.timeScale)
+            return
+        if tagged and action in QUERY_ACTIONS:
+            # Tagged queries are answered from the control loop, even mid-motion.
+            respond(Framing.STATUS_OK, self.query(action), 0.005 * self.timeScale)
+            return
+        # Everything else runs strictly one after the other.
+        start = max(loop.time(), self.busyUntil)
+        if action == "script" and self.protocol >= 5:
+            # Steps run back to back; a collision ends the script and is
+            # reported in its result instead of as a separate reply.
+            results = []
+            for step in params:
+                stepParts = step.split(",")
+                if stepParts[0] not in Framing.OPCODES.values():
+                    results.append("error:unknown action " + stepParts[0])
+                    break
+                finish, response, hit = self.step(stepParts[0], stepParts[1:], start)
+                if hit is not None:
+                    results.append("linedetected")
+                    break
+                results.append(response or "ok")
+                start = finish
+            self.busyUntil = finish
+            respond(Framing.STATUS_OK, ";".join(results), finish - loop.time())
+            return
+        finish, response, hit = self.step(action, params, start)
+        if hit is not None:
+            respond(Framing.STATUS_LINEDETECTED, "", hit - loop.time())
+        self.busyUntil = finish
+        respond(Framing.STATUS_OK, response, finish - loop.time())
+
+    # Returns when a command started at 'start' finishes, its response and
+    # when it hit a line (None if it did not).
+    def step(self, action, params, start):
+        finish = start + self.duration(action, params) * self.timeScale
+        response = self.query(action)
+        if action == "searchandgrab":
+            response = "success"
+        if action == "search":
+            response = "notfound|angle=0|distance=2000|profile="
+        if action == "drive" and self.random.random() < self.collisionRate:
+            hit = start + (finish - start) * self.random.random()
+            return hit + GAMEOVER_SOUND * self.timeScale, response, hit
+        return finish, response, None
+
+    def query(self, action):
+        if action == "version":
+            return str(self.protocol)
+        if action == "sensors":
+            return "distance=2000|reflection=40|heading=0"
+        return ""
+
+    # Drops the BLE link and keeps the hub out of reach for 'outage' seconds.
+    def drop_link(self, outage):
+        client = self.client
+        self.reachable = False
+        self.notify = None
+        self.client = None
+        asyncio.get_running_loop().call_later(outage, self.restore_link)
+        if client is not None:
+            client.is_connected = False
+            if client.disconnected_callback is not None:
+                client.disconnected_callback(client)
+
+    def restore_link(self):
+        self.reachable = True
+
+    def receive(self, data):
+        for byte in data:
+            item = self.reader.add(byte)
+            if isinstance(item, Framing.LongCommand):
+                self.reply(self.text("error>instruction too long"), 0)
+            elif isinstance(item, str):
+                self.handle(item)
+            elif item is not None:
+                self.handle_frame(item)
+
+hubs = {}
+
+def add_hub(hub):
+    hubs[hub.name] = hub
+    return hub
+
+class FakeDevice:
+    def __init__(self, hub):
+        self.hub = hub
+        self.name = hub.name
+        self.address = hub.address
+
+class FakeCharacteristic:
+    def __init__(self, uuid, hub):
+        self.uuid = uuid
+        self.properties = ["write", "write-without-response"] if hub.writeWithoutResponse else ["write"]
+        self.max_write_without_response_size = hub.mtu - ATT_HEADER
+
+class FakeService:
+    def __init__(self, hub):
+        self.hub = hub
+
+    def get_characteristic(self, uuid):
+        return FakeCharacteristic(uuid, self.hub)
+
+class FakeServices:
+    def __init__(self, hub):
+        self.hub = hub
+
+    def get_service(self, uuid):
+        return FakeService(self.hub)
+
+def hub_by_address(address):
+    for hub in hubs.values():
+        if hub.address == address:
+            return hub
+    return None
+
+class FakeBleakScanner:
+    # Scans so far, to check that a cached address skips them.
+    scans = 0
+
+    @staticmethod
+    async def find_device_by_name(name, timeout=10.0, **kwargs):
+        FakeBleakScanner.scans += 1
+        hub = hubs.get(name)
+        if hub is None or not hub.reachable:
+            await asyncio.sleep(timeout)
+            return None
+        await asyncio.sleep(SCAN_TIME * hub.timeScale)
+        return FakeDevice(hub)
+
+class FakeBleakClient:
+    def __init__(self, device, disconnected_callback=None, **kwargs):
+        if isinstance(device, str):
+            self.hub = hub_by_address(device)
+        else:
+            self.hub = device.hub
+        self.address = device if isinstance(device, str) else device.address
+        self.disconnected_callback = disconnected_callback
+        self.services = FakeServices(self.hub)
+        self.is_connected = False
+
+    async def connect(self, **kwargs):
+        if self.hub is None:
+            raise Exception(f"Device with address {self.address} was not found")
+        await asyncio.sleep(CONNECT_TIME * self.hub.timeScale)
+        if not self.hub.reachable:
+            raise Exception(f"Device with address {self.address} is not reachable")
+        self.is_connected = True
+        self.mtu_size = self.hub.mtu
+        self.hub.client = self
+        return True
+
+    async def disconnect(self):
+        self.is_connected = False
+        if self.hub.client is self:
+            self.hub.client = None
+            self.hub.notify = None
+        return True
+
+    async def start_notify(self, uuid, callback, **kwargs):
+        self.hub.notify = callback
+        # Only the first connection finds the program waiting to be started;
+        # after a reconnect it is still running and does not greet again.
+        if not self.hub.running:
+            self.hub.running = True
+            self.hub.hello()
+
+    async def write_gatt_char(self, char, data, response=None):
+        if not self.is_connected:
+            raise Exception("Not connected")
+        if len(data) > self.hub.mtu - ATT_HEADER:
+            raise Exception(f"Write of {len(data)} bytes exceeds MTU {self.hub.mtu}")
+        # A write with response waits for the hub's acknowledgement, one
+        # without only for the next connection event.
+        if response:
+            await asyncio.sleep(self.hub.linkLatency)
+            self.hub.receive(data)
+            await asyncio.sleep(self.hub.linkLatency)
+        else:
+            asyncio.get_running_loop().call_later(self.hub.linkLatency, self.hub.receive, bytes(data))
+            await asyncio.sleep(0.0075)
+
+def install(module):
+    module.BleakScanner = FakeBleakScanner
+    module.BleakClient = FakeBleakClient
@@ -0,0 +1,48 @@
+import socket
+
+import pytest
+
+import bench_camera_upload as bench
+import fake_picamera
+import harness
+
+# The camera agent must upload a photo from the capture buffer: what the
+# upload allocates on top of the capture (tracemalloc) stays far below the
+# size of the photo. The mock Pega server runs in its own process, so that
+# only the agent's allocations are traced.
+
+MAX_EXTRA = 64 * 1024
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+@pytest.fixture(scope="module")
+def camera():
+    port = free_port()
+    server = bench.start_mock_server(port)
+    try:
+        fake_picamera.timeScale = 0
+        agent = harness.load_camera_agent(port, "Sim Camera")
+        camera = agent.CameraController("Sim Camera")
+        # Token and connection are set up outside the measurement.
+        bench.upload_after(agent, camera, bench.capture_after(agent, camera))
+        yield agent, camera
+    finally:
+        server.kill()
+
+@pytest.mark.parametrize("resolution", bench.RESOLUTIONS)
+def test_upload_does_not_copy_the_photo(camera, resolution):
+    agent, camera = camera
+    camera.setResolution(resolution)
+    _, extra, size = bench.measure(bench.capture_after, bench.upload_after, agent, camera)
+    assert size > MAX_EXTRA
+    assert extra <= MAX_EXTRA
+
+def test_measurement_sees_a_copy(camera):
+    # The old upload read the photo into bytes; the check has to catch that.
+    agent, camera = camera
+    camera.setResolution("medium")
+    _, extra, size = bench.measure(bench.capture_before, bench.upload_before, agent, camera)
+    assert extra >= size
@@ -0,0 +1,104 @@
+import os
+import random
+import sys
+
+BRIDGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Bot to Pega Bridge")
+sys.path.insert(0, BRIDGE_DIR)
+import hub_framing
+
+# ResponseFramer with the notifications of a protocol 4 hub cut at random
+# points and partly run together, as BLE may deliver them.
+
+def reply_frame(status, seq, payload):
+    data = payload.encode("utf-8")
+    body = bytes([status, seq, len(data)]) + data
+    return bytes([hub_framing.START]) + body + bytes([sum(body) & 0xFF])
+
+def random_messages(rng, count):
+    messages = []
+    for i in range(count):
+        seq = rng.randrange(256)
+        kind = rng.randrange(4)
+        if kind == 0:
+            messages.append((f"#{seq}:OK distance={rng.randrange(2000)}".encode("utf-8"), b"\n"))
+        elif kind == 1:
+            messages.append((f"#{seq}:error>Unknown command".encode("utf-8"), b"\r\n"))
+        elif kind == 2:
+            messages.append((b"linedetected", b"\n"))
+        else:
+            # Payloads may hold newlines and the START byte (in the utf-8 of ¥).
+            payload = rng.choice(["", "distance=12", "color=Color.RED\nreflection=40", "¥" * rng.randrange(1, 90)])
+            messages.append((reply_frame(rng.randrange(3), seq, payload), b""))
+    return messages
+
+def cut(rng, stream):
+    chunks = []
+    start = 0
+    while start < len(stream):
+        end = start + rng.randrange(1, 21)
+        chunks.append(stream[start:end])
+        start = end
+    return chunks
+
+def coalesce(rng, chunks):
+    joined = []
+    for chunk in chunks:
+        if joined and rng.random() < 0.3:
+            joined[-1] += chunk
+        else:
+            joined.append(chunk)
+    return joined
+
+def test_fragmented_and_coalesced_notifications_give_the_original_messages():
+    rng = random.Random(4)
+    for run in range(200):
+        received = []
+        framer = hub_framing.ResponseFramer(received.append)
+        # The hub's first Hello arrives whole; after its newline the
+        # framer splits on newlines.
+        framer.feed(b"Hello\n")
+        messages = random_messages(rng, rng.randrange(1, 30))
+        stream = b"".join(message + ending for message, ending in messages)
+        for chunk in coalesce(rng, cut(rng, stream)):
+            framer.feed(bytearray(chunk))
+        assert received == [b"Hello"] + [message for message, ending in messages]
+        assert not framer.buffer
+
+def test_frames_are_decoded_after_reassembly():
+    received = []
+    framer = hub_framing.ResponseFramer(received.append)
+    frame = reply_frame(hub_framing.STATUS_OK, 7, "distance=12")
+    for i in range(len(frame)):
+        framer.feed(frame[i:i + 1])
+    assert received == [frame]
+    assert hub_framing.decode_reply(received[0]) == (hub_framing.STATUS_OK, 7, "distance=12")
+
+def test_before_the_first_newline_every_notification_is_a_message():
+    # Older hubs end no reply with a newline.
+    received = []
+    framer = hub_framing.ResponseFramer(received.append)
+    framer.feed(b"Hello")
+    framer.feed(b"OK distance=12")
+    assert received == [b"Hello", b"OK distance=12"]
+    assert not framer.delimited
+
+def test_fragmented_first_hello_is_dispatched_in_parts():
+    # Until a newline has been seen a notification cannot be told from a
+    # whole reply of an older hub, so a first Hello that BLE splits is
+    # dispatched as its parts; from the newline on the framer reassembles.
+    received = []
+    framer = hub_framing.ResponseFramer(received.append)
+    framer.feed(b"Hel")
+    framer.feed(b"lo\n#1:O")
+    framer.feed(b"K\n")
+    assert received == [b"Hel", b"lo", b"#1:OK"]
+    assert framer.delimited
+
+def test_reset_forgets_the_delimiter_and_partial_messages():
+    received = []
+    framer = hub_framing.ResponseFramer(received.append)
+    framer.feed(b"Hello\n#2:OK dis")
+    framer.reset()
+    framer.feed(b"Hello")
+    assert received == [b"Hello", b"Hello"]
+    assert not framer.delimited
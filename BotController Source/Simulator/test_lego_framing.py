@@ -0,0 +1,50 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+import simulated_hub
+
+# LegoController with binary framing against the simulated hub, for
+# commands and replies that do not fit into a frame.
+
+BRIDGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Bot to Pega Bridge")
+sys.path.insert(0, BRIDGE_DIR)
+import lego_controller
+
+simulated_hub.install(lego_controller)
+
+async def run_binary(name, commands):
+    hub = simulated_hub.add_hub(simulated_hub.SimulatedHub(name, timeScale=0.01))
+    lego = lego_controller.LegoController(name, lambda: None, binary=True)
+    await lego.connect()
+    assert lego.uses_frames()
+    results = []
+    try:
+        for action, parameters in commands:
+            try:
+                results.append(await lego.execute(action, parameters, timeout=5))
+            except lego_controller.LegoControllerException as e:
+                results.append(e)
+    finally:
+        await lego.disconnect()
+    return hub, results
+
+def test_commands_too_long_for_a_frame_are_sent_as_text():
+    text = "x" * 300
+    script = "|".join(["display,ab"] * 40)
+    hub, results = asyncio.run(run_binary("Long Hub", [("display", text), ("script", script), ("turn", "90")]))
+    assert results == ["", ";".join(["ok"] * 40), ""]
+    # The version query of the negotiation is text, too; the turn is a frame.
+    sent = [command for command in hub.commands if isinstance(command, str)]
+    assert sent[1:] == ["#2:display>" + text, "#3:script>" + script]
+    assert isinstance(hub.commands[-1], bytes)
+
+def test_reply_too_long_for_a_frame_is_an_error():
+    script = "|".join(["sensors"] * 10)
+    hub, results = asyncio.run(run_binary("Chatty Hub", [("script", script), ("turn", "90")]))
+    assert isinstance(results[0], lego_controller.LegoControllerException)
+    assert results[0].type == "error"
+    assert "longer than 255 bytes" in results[0].message
+    assert results[1] == ""
@@ -0,0 +1,75 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+import simulated_hub
+
+# LegoController against the simulated hub and fake bleak client, with the
+# link dropped while a drive is running.
+
+BRIDGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Bot to Pega Bridge")
+sys.path.insert(0, BRIDGE_DIR)
+import lego_controller
+import metrics
+
+simulated_hub.install(lego_controller)
+
+async def drop_during_execute(name, cache):
+    hub = simulated_hub.add_hub(simulated_hub.SimulatedHub(name, timeScale=0.05))
+    lego = lego_controller.LegoController(name, lambda: None, addressCache=cache, reconnectMaxDelay=0.2,
+                                          metrics=metrics.Metrics())
+    await lego.connect()
+    scans = simulated_hub.FakeBleakScanner.scans
+    # 20 steps take 0.5 s at this time scale.
+    drive = asyncio.create_task(lego.execute("drive", "20", timeout=10))
+    await asyncio.sleep(0.1)
+    pending = list(lego.pending.values())
+    hub.drop_link(0.3)
+    with pytest.raises(lego_controller.LegoControllerException) as error:
+        await drive
+    await lego.reconnectTask
+    response = await lego.execute("sensors", "", timeout=5)
+    await lego.disconnect()
+    return lego, pending, error.value, response, simulated_hub.FakeBleakScanner.scans - scans
+
+def test_drop_fails_commands_in_flight_and_later_ones_succeed(tmp_path):
+    cache = str(tmp_path / "hub_addresses.json")
+    lego, pending, error, response, scans = asyncio.run(drop_during_execute("Test Hub", cache))
+    assert len(pending) == 1
+    assert all(command.future.done() and command.event == "disconnected" for command in pending)
+    assert error.type == "disconnected"
+    assert response.startswith("distance=")
+    assert lego.event == ""
+    assert lego.reconnects == 1
+    # The reconnect used the cached address, not a scan.
+    assert scans == 0
+    assert 'bridge_reconnect_seconds_count{robot="Test Hub"} 1' in lego.metrics.render()
+
+def test_reconnect_without_cache_scans(tmp_path):
+    lego, pending, error, response, scans = asyncio.run(drop_during_execute("Scanned Hub", None))
+    assert error.type == "disconnected"
+    assert response.startswith("distance=")
+    assert scans >= 1
+
+async def command_while_protocol_1_hub_reconnects(cache):
+    hub = simulated_hub.add_hub(simulated_hub.SimulatedHub("Old Hub", timeScale=0.05, protocol=1))
+    lego = lego_controller.LegoController("Old Hub", lambda: None, addressCache=cache, reconnectMaxDelay=0.2)
+    await lego.connect()
+    hub.drop_link(0.3)
+    await asyncio.sleep(0.05)
+    # Waits for the link; the version query of the reconnect must not
+    # answer it.
+    response = await lego.execute("drive", "20", timeout=10)
+    await lego.reconnectTask
+    await lego.disconnect()
+    return lego, hub, response
+
+def test_untagged_command_is_not_answered_by_the_version_query(tmp_path):
+    cache = str(tmp_path / "hub_addresses.json")
+    lego, hub, response = asyncio.run(command_while_protocol_1_hub_reconnects(cache))
+    assert response == ""
+    assert lego.event == ""
+    assert lego.protocol == 1
+    assert "drive>20" in hub.commands
@@ -0,0 +1,64 @@
+import asyncio
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+BRIDGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Bot to Pega Bridge")
+sys.path.insert(0, BRIDGE_DIR)
+from pega_client import PegaClient, PegaClientException
+
+# Retries of the Bridge's Pega calls against a server that answers every
+# call with 503 or drops the connection without an answer.
+
+class FailingHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def answer(self):
+        self.server.calls.append(self.command)
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.server.drop:
+            self.close_connection = True
+            return
+        self.send_response(503)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    do_GET = answer
+    do_PUT = answer
+
+@pytest.fixture(params=[False, True], ids=["503", "no answer"])
+def server(request):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FailingHandler)
+    server.calls = []
+    server.drop = request.param
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+async def call(server, method):
+    client = PegaClient(f"http://127.0.0.1:{server.server_port}/", "bench", "bench", timeout=2, retries=3, backoff=0)
+    try:
+        if method == "GET":
+            await client.fetch_instructions("R1")
+        else:
+            await client.update_instruction("R1", "I-1", "{}")
+    except PegaClientException:
+        pass
+    finally:
+        client.close()
+
+def test_next_instruction_is_not_sent_twice(server):
+    # The first GET may have leased an instruction whose answer was lost.
+    asyncio.run(call(server, "GET"))
+    assert server.calls == ["GET"]
+
+def test_result_is_retried(server):
+    asyncio.run(call(server, "PUT"))
+    assert server.calls == ["PUT"] * 4
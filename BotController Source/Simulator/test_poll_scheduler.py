@@ -0,0 +1,111 @@
+import os
+import socket
+import sys
+import time
+
+import pytest
+import requests
+
+import harness
+import mock_pega_server
+
+# The Bridge and the Camera agent are deployed to different machines, each
+# from its own folder, so both carry a copy of poll_scheduler.py. They may
+# only differ in the line that names the other copy.
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+COPIES = ["Bot to Pega Bridge", "Camera Embedded"]
+
+sys.path.insert(0, os.path.join(SOURCE_DIR, COPIES[0]))
+from poll_scheduler import FAST_EMPTY_LIMIT, PollScheduler
+
+def read_copy(folder):
+    with open(os.path.join(SOURCE_DIR, folder, "poll_scheduler.py")) as file:
+        return [line for line in file if not line.startswith("# Keep in sync with the copy in ")]
+
+def test_copies_match():
+    bridge, camera = (read_copy(folder) for folder in COPIES)
+    assert bridge == camera
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+@pytest.fixture
+def server():
+    servers = []
+    def start(longPoll):
+        server = mock_pega_server.start_server(free_port(), longPoll=longPoll)
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+# One round of the agents' poll loop against the queue at 'port'.
+def poll(scheduler, port):
+    scheduler.poll_started()
+    wait = scheduler.long_poll_wait()
+    try:
+        response = requests.get(harness.base_url(port) + "robot/R1/instructions/next",
+                                params={"wait": wait} if wait else None, timeout=5)
+    except requests.ConnectionError:
+        scheduler.got_error()
+        return None
+    if response.status_code == 200:
+        scheduler.got_instruction()
+        return response.json()
+    scheduler.got_nothing()
+    return None
+
+def test_held_long_poll_polls_again_at_once(server):
+    port = server(longPoll=True).server_port
+    scheduler = PollScheduler(longPoll=0.4)
+    started = time.monotonic()
+    assert poll(scheduler, port) is None
+    assert time.monotonic() - started >= 0.4
+    assert scheduler.next_delay() == 0
+    assert scheduler.long_poll_wait() == 0.4
+
+def test_immediate_204_backs_off_and_ends_long_polling(server):
+    port = server(longPoll=False).server_port
+    scheduler = PollScheduler(minDelay=0.1, maxDelay=5.0, jitter=0, longPoll=2)
+    delays = []
+    for i in range(FAST_EMPTY_LIMIT):
+        assert scheduler.long_poll_wait() == 2
+        poll(scheduler, port)
+        delays.append(scheduler.next_delay())
+    assert delays == [0.1 * 2 ** i for i in range(FAST_EMPTY_LIMIT)]
+    assert scheduler.long_poll_wait() is None
+
+def test_error_backoff_stops_at_max_delay():
+    port = free_port()
+    scheduler = PollScheduler(minDelay=0.1, maxDelay=0.5, jitter=0)
+    delays = []
+    for i in range(6):
+        poll(scheduler, port)
+        delays.append(scheduler.next_delay())
+    assert delays == [0.1, 0.2, 0.4, 0.5, 0.5, 0.5]
+
+def test_instruction_resets_delay_and_long_polling(server):
+    mock = server(longPoll=False)
+    scheduler = PollScheduler(minDelay=0.1, jitter=0, longPoll=2)
+    for i in range(FAST_EMPTY_LIMIT):
+        poll(scheduler, mock.server_port)
+    assert scheduler.next_delay() > 0
+    assert scheduler.long_poll_wait() is None
+    mock.queue.add("R1", "drive", "1")
+    assert poll(scheduler, mock.server_port)["Action"] == "drive"
+    assert scheduler.next_delay() == 0
+    assert scheduler.long_poll_wait() == 2
+
+def test_poll_rate_counts_the_polls_of_the_window(server):
+    port = server(longPoll=False).server_port
+    scheduler = PollScheduler(window=0.5)
+    for i in range(5):
+        poll(scheduler, port)
+    assert scheduler.poll_rate() == 5 / 0.5
+    time.sleep(0.6)
+    assert scheduler.poll_rate() == 0
@@ -0,0 +1,201 @@
+# Parsing of instructions, without any pybricks dependency.
+#
+# Text instructions:    [action]>[param]|[param]
+# Binary instructions:  START opcode seq length [args] checksum
+#   args are typed: ARG_INT + int16 (little endian) or ARG_STR + length + utf-8
+#   checksum is the sum of opcode, seq, length and args, modulo 256
+# Binary replies:       START status seq length [utf-8 payload] checksum
+
+START = 0xA5
+HEADER_SIZE = 4
+
+ARG_INT = 0x01
+ARG_STR = 0x02
+
+# Bytes of a reply payload; the length is one byte.
+MAX_PAYLOAD = 255
+
+STATUS_OK = 0
+STATUS_LINEDETECTED = 1
+STATUS_ERROR = 2
+
+OPCODES = {
+    1: "drive",
+    2: "turn",
+    3: "display",
+    4: "searchandgrab",
+    5: "releasegrabber",
+    6: "dance",
+    7: "setting",
+    8: "sensors",
+    9: "version",
+    10: "script",
+    11: "search",
+}
+
+# Argument specs of the commands: (name, type, default), with the type INT
+# or STR and REQUIRED as default for arguments that must be given.
+INT = "int"
+STR = "str"
+REQUIRED = object()
+CONVERT = {INT: int, STR: str}
+
+# Raised for instructions that cannot be run as given; the hub answers them
+# with an error reply.
+class CommandError(Exception):
+    pass
+
+# Checks a table of action: (handler, specs, rest) once at start-up.
+def checkSpecs(commands):
+    for action in commands:
+        handler, specs, rest = commands[action]
+        optional = False
+        for name, kind, default in specs:
+            if kind not in CONVERT:
+                raise ValueError(action + ": unknown type of " + name)
+            if default is REQUIRED and optional:
+                raise ValueError(action + ": " + name + " follows an optional argument")
+            optional = default is not REQUIRED
+
+# Returns the handler arguments for params, converted and with defaults
+# filled in; with rest, the remaining params are passed as one list.
+def convertArgs(action, specs, rest, params):
+    count = len(params)
+    while count > 0 and params[count - 1] == "":
+        count -= 1
+    if count > len(specs) and not rest:
+        raise CommandError(action + " takes at most " + str(len(specs)) + " arguments")
+    args = []
+    for i in range(len(specs)):
+        name, kind, default = specs[i]
+        if i >= count or params[i] == "":
+            if default is REQUIRED:
+                raise CommandError(action + ": missing " + name)
+            args.append(default)
+            continue
+        try:
+            args.append(CONVERT[kind](params[i]))
+        except ValueError:
+            raise CommandError(action + ": " + name + " must be " + kind)
+    if rest:
+        args.append(list(params[len(specs):count]))
+    return args
+
+def parseText(cmd):
+    cmdParts = cmd.split(">")
+    action = cmdParts[0]
+    try:
+        params = cmdParts[1].split("|")
+    except IndexError as e:
+        params = []
+    return action, params
+
+def checksum(frame, end):
+    total = 0
+    for i in range(1, end):
+        total += frame[i]
+    return total & 0xFF
+
+def frameSize(header):
+    return HEADER_SIZE + header[3] + 1
+
+# Returns (action, seq, params) for a complete frame, or raises ValueError.
+def parseFrame(frame):
+    length = frame[3]
+    end = HEADER_SIZE + length
+    if len(frame) != end + 1 or frame[0] != START:
+        raise ValueError("bad frame")
+    if checksum(frame, end) != frame[end]:
+        raise ValueError("bad checksum")
+    action = OPCODES.get(frame[1])
+    if action is None:
+        raise ValueError("bad opcode")
+    params = []
+    i = HEADER_SIZE
+    while i < end:
+        if frame[i] == ARG_INT:
+            value = frame[i + 1] | (frame[i + 2] << 8)
+            if value >= 0x8000:
+                value -= 0x10000
+            params.append(value)
+            i += 3
+        elif frame[i] == ARG_STR:
+            size = frame[i + 1]
+            params.append(str(frame[i + 2:i + 2 + size], "utf-8"))
+            i += 2 + size
+        else:
+            raise ValueError("bad argument")
+    return action, frame[2], params
+
+# Bytes a single instruction may have; the bridge waits for an acknowledgement
+# after at most this many bytes, too.
+RX_SIZE = 512
+CR = 13
+
+# The start of a text instruction that did not fit into RX_SIZE bytes.
+class LongCommand:
+    def __init__(self, head):
+        self.head = head
+
+# Collects received bytes in one preallocated buffer and hands out complete
+# instructions: text lines up to the carriage return as str, binary frames as
+# bytearray. Adding a byte allocates nothing; a complete instruction costs
+# the one object it is handed out as, decoded or copied straight from the
+# buffer.
+class CommandReader:
+    def __init__(self, size=RX_SIZE):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.size = size
+        self.length = 0
+        # Size of the binary frame being received, -1 until its header is in.
+        self.frameSize = 0
+        self.overflow = False
+
+    def reset(self):
+        self.length = 0
+        self.frameSize = 0
+        self.overflow = False
+
+    # Adds one received byte; returns a complete instruction or None.
+    def add(self, byte):
+        if self.frameSize != 0:
+            self.buffer[self.length] = byte
+            self.length += 1
+            if self.length == HEADER_SIZE:
+                self.frameSize = HEADER_SIZE + byte + 1
+            if self.length == self.frameSize:
+                frame = self.buffer[:self.length]
+                self.reset()
+                return frame
+            return None
+        if byte == CR:
+            line = str(self.view[:self.length], "utf-8")
+            if self.overflow:
+                line = LongCommand(line)
+            self.reset()
+            return line
+        if self.length == 0 and byte == START:
+            self.frameSize = -1
+        if self.length < self.size:
+            self.buffer[self.length] = byte
+            self.length += 1
+        else:
+            # Keep the start (with the tag) and drop the rest of the line.
+            self.overflow = True
+        return None
+
+def buildReply(status, seq, payload=""):
+    data = payload.encode("utf-8")
+    if len(data) > MAX_PAYLOAD:
+        # The sender gets an error instead of no reply and its timeout.
+        status = STATUS_ERROR
+        data = ("reply longer than " + str(MAX_PAYLOAD) + " bytes").encode("utf-8")
+    frame = bytearray(HEADER_SIZE + len(data) + 1)
+    frame[0] = START
+    frame[1] = status
+    frame[2] = seq
+    frame[3] = len(data)
+    frame[HEADER_SIZE:HEADER_SIZE + len(data)] = data
+    frame[-1] = checksum(frame, HEADER_SIZE + len(data))
+    return frame
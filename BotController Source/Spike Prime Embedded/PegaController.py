@@ -1,5 +1,5 @@
 from pybricks.hubs import PrimeHub
-from pybricks.tools import wait
+from pybricks.tools import StopWatch
 from pybricks.parameters import Color, Button
 
 # Standard MicroPython modules
@@ -8,6 +8,7 @@ from uselect import poll
 
 # Custom Robot Controller
 import RobotController
+import Framing
 
 hub = PrimeHub()
 
@@ -16,39 +17,171 @@ hub = PrimeHub()
 keyboard = poll()
 keyboard.register(stdin)
 
-def main():
-    keyboard = poll()
-    keyboard.register(stdin)
+# Protocol 2 commands carry a sequence tag that is echoed in every reply:
+# #[seq]:[action]>[param]|[param]  ->  #[seq]:OK>[response]
+# Untagged commands are protocol 1 and are answered untagged.
+# Protocol 3 adds binary frames (see Framing.py), which are answered with
+# binary frames; text instructions keep working next to them.
+# Protocol 4 ends every text reply with a newline, so the bridge can split
+# replies that BLE fragments or coalesces.
+# Protocol 5 adds the script action (see RobotController).
+# Instructions that cannot be run are answered with #[seq]:error>[message]
+# (or an error frame) instead of OK.
+PROTOCOL_VERSION = 5
+REPLY_END = "\n"
+# Tagged commands with these actions are answered even while a motion runs.
+QUERY_ACTIONS = ("display", "sensors", "version")
+
+reader = Framing.CommandReader()
+received = bytearray(1)
+deferred = []
+# Longest time in ms the hub waits for input before its tasks run again.
+TICK = 10
+# The buttons are read every BUTTON_PERIOD ms.
+BUTTON_PERIOD = 50
+
+def reply(text):
+    stdout.write(text + REPLY_END)
+    stdout.flush()
+
+def replyFrame(status, seq, payload=""):
+    stdout.buffer.write(Framing.buildReply(status, seq, payload))
+    stdout.flush()
+
+def splitTag(line):
+    if line.startswith("#"):
+        tag, line = line[1:].split(":", 1)
+        return "#" + tag + ":", line
+    return "", line
+
+def execute(action, params):
+    if action == "version":
+        return str(PROTOCOL_VERSION)
+    return RobotController.dispatch(action, params)
+
+def runCommand(item):
+    outer = RobotController.notifier
+    try:
+        if isinstance(item, Framing.LongCommand):
+            prefix = ""
+            if item.head.startswith("#") and ":" in item.head:
+                prefix = splitTag(item.head)[0]
+            reply(prefix + "error>instruction longer than " + str(Framing.RX_SIZE) + " bytes")
+        elif isinstance(item, str):
+            prefix, command = splitTag(item)
+            action, params = Framing.parseText(command)
+            RobotController.notifier = lambda message: reply(prefix + message)
+            try:
+                response = execute(action, params)
+            except Exception as e:
+                reply(prefix + "error>" + str(e))
+                return
+            reply(prefix + "OK" + ">" + response)
+        else:
+            try:
+                action, seq, params = Framing.parseFrame(item)
+            except ValueError as e:
+                replyFrame(Framing.STATUS_ERROR, item[2], str(e))
+                return
+            RobotController.notifier = lambda message: replyFrame(Framing.STATUS_LINEDETECTED, seq)
+            try:
+                response = execute(action, params)
+            except Exception as e:
+                replyFrame(Framing.STATUS_ERROR, seq, str(e))
+                return
+            replyFrame(Framing.STATUS_OK, seq, response)
+    finally:
+        RobotController.notifier = outer
+
+def isQuery(item):
+    if isinstance(item, Framing.LongCommand):
+        return False
+    if isinstance(item, str):
+        prefix, command = splitTag(item)
+        return prefix != "" and command.split(">")[0] in QUERY_ACTIONS
+    return Framing.OPCODES.get(item[1]) in QUERY_ACTIONS
 
+# Waits up to timeout ms for input; returns as soon as a byte has arrived.
+def inputWaiting(timeout=0):
+    # ipoll reuses its result, unlike poll, which builds a list every call.
+    for ready in keyboard.ipoll(timeout):
+        return True
+    return False
+
+# Drains all bytes that have arrived into the reader and returns the complete
+# text lines (str) and binary frames (bytearray). Each byte is read into the
+# same one-byte buffer, so reading a byte allocates nothing.
+def readCommands():
+    items = []
+    while inputWaiting():
+        if stdin.buffer.readinto(received, 1) != 1:
+            continue
+        item = reader.add(received[0])
+        if item is not None:
+            items.append(item)
+    return items
+
+# Called by RobotController while a motion runs: queries are answered right
+# away, everything else is executed in order once the motion is done.
+def serviceQueries():
+    for item in readCommands():
+        if isQuery(item):
+            runCommand(item)
+        else:
+            deferred.append(item)
+
+# Cooperative tasks: generators that do a short piece of work per step and
+# yield. They are stepped while the hub waits for input and during motions,
+# so none of them holds up the instructions. (The firmware in this folder,
+# pybricks 3.2.3, predates pybricks.tools.multitask.)
+tasks = []
+
+def runTasks():
+    for task in tasks:
+        next(task)
+
+# LEFT tightens the grabber. The motor runs in the background, so
+# instructions keep coming in while it turns.
+def buttonTask():
+    timer = StopWatch()
+    held = False
+    while True:
+        if timer.time() >= BUTTON_PERIOD:
+            timer.reset()
+            pressed = Button.LEFT in hub.buttons.pressed()
+            if pressed and not held:
+                RobotController.tightenGrabber(wait=False)
+            held = pressed
+        yield
+
+# RobotController's idle hook: waits for input for at most one tick.
+def whileBusy(timeout):
+    inputWaiting(timeout)
+    serviceQueries()
+    runTasks()
+
+def main():
     RobotController.setup()
+    RobotController.idleHook = whileBusy
+    tasks.append(buttonTask())
 
     hub.light.on(Color.RED)
     hub.display.text("ok")
-    cmd = b""
-    stdout.write("Hello")
-    stdout.flush()
+    reader.reset()
+    reply("Hello")
     hub.light.on(Color.GREEN)
     while True:
-        while not keyboard.poll(0):
-            pressed = []
-            pressed = hub.buttons.pressed()
-            if Button.LEFT in pressed:
-                RobotController.tightenGrabber()
-            wait(10)
-        char = b""
+        runTasks()
+        # Sleeps until input arrives, but no longer than a tick.
+        if not deferred and not inputWaiting(TICK):
+            continue
         try:
-            char = stdin.buffer.read(1)
-            if char == b"\r":
-                param = str(cmd, "utf-8")
-                response = RobotController.handleCommand(param)
-                stdout.write("OK" + ">" + response)
-                stdout.flush()
-                cmd = b""
-            elif char != b"":
-                cmd = cmd + char
+            deferred.extend(readCommands())
+            while deferred:
+                runCommand(deferred.pop(0))
         except Exception as e:
-            stdout.buffer.write(bytearray(str(e)))
-            cmd = b""
+            stdout.buffer.write(bytearray(str(e) + REPLY_END))
+            reader.reset()
             hub.display.text("Error")
 
 if __name__ == '__main__':
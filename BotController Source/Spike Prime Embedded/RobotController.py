@@ -5,12 +5,17 @@ from pybricks.robotics import DriveBase
 from pybricks.tools import wait, StopWatch
 from usys import stdin, stdout
 
+import Framing
+
 
 STEP_UNIT = 100
 BLACK_REFLECTION = 20
 SEARCH_RANGE = 800
 SEARCH_ANGLE = 40
 SEARCH_CLOSENESS = 80
+SWEEP_RATE = 60 # deg/s while sweeping for an object
+SWEEP_TOLERANCE = 10 # mm; readings this close to the nearest belong to the same object
+PROFILE_POINTS = 20 # points of the distance profile returned by search
 
 hub = PrimeHub()
 
@@ -34,43 +39,81 @@ def setup():
 shortestDistance = SEARCH_RANGE
 shortestAngle = 0 
 
+# Set by PegaController: a function that sends notifications such as
+# "linedetected" for the running command (tagged or framed as it came in),
+# and a function that is called on every control-loop tick with the tick
+# length in ms, so queries can be answered mid-motion. It returns once input
+# arrives or the tick is over. The tick is set with setting>tick=[ms].
+notifier = None
+idleHook = None
+TICK = 10
+
 # commands follow the following structure
 # [action] > [param] | [param]
 # e.g. drive>50
+# A script runs several steps in one command, each step [action],[param],...
+# e.g. script>drive,3|turn,90|drive,2,true
+# and answers with the result of every step that ran, separated by ";":
+# "ok", the step's response, "linedetected" for the step that hit a line or
+# "error:[message]" for a step that could not run (the script stops there).
+SCRIPT_ARGS = ","
+SCRIPT_RESULTS = ";"
 
 def handleCommand(cmd):
-    response = ""
-    cmdParts = cmd.split(">")
-    action = cmdParts[0]
+    action, params = Framing.parseText(cmd)
+    return dispatch(action, params)
+
+# params are strings for text instructions and may be ints for binary ones.
+# Raises Framing.CommandError for unknown actions and bad arguments.
+def dispatch(action, params):
+    command = COMMANDS.get(action)
+    if command is None:
+        raise Framing.CommandError("unknown action " + str(action))
+    handler, specs, rest = command
+    response = handler(*Framing.convertArgs(action, specs, rest, params))
+    if response is None:
+        return ""
+    return response
+
+# drive>[steps]|[ignore]  or  drive>until|[color]|[ignore]
+def driveCommand(target, option, ignore):
+    if target == "until":
+        # option defaults to "false", so a missing color ends up here too.
+        if option not in COLORS:
+            raise Framing.CommandError("drive: until needs a color, one of " + ", ".join(COLORS))
+        driveUntil(option, ignore)
+    else:
+        try:
+            steps = int(target)
+        except ValueError:
+            raise Framing.CommandError("drive: steps must be int or until")
+        drive(steps, option)
+
+def display(text):
+    hub.display.text(text)
+
+def runScript(steps):
+    global notifier
+    outer = notifier
+    collisions = []
+    # Collisions end the step instead of the whole command.
+    notifier = lambda message: collisions.append(message)
+    results = []
     try:
-        params = cmdParts[1].split("|")
-    except IndexError as e:
-        params = []
-    if action == "drive":
-        if params[0] == "until":
-            driveUntil(params[1], params[2])
-        else:
+        for step in steps:
+            stepParts = str(step).split(SCRIPT_ARGS)
             try:
-                drive(int(params[0]), params[1])
-            except IndexError:
-                drive(int(params[0]), "false")
-    elif action == "turn":
-        turn(int(params[0]))
-    elif action == "display":
-        hub.display.text(params[0])
-    elif action == "searchandgrab":
-        try:
-            response = searchAndGrab(int(params[0]), int(params[1]))
-        except IndexError:
-            response = searchAndGrab(SEARCH_RANGE, SEARCH_ANGLE)
-    elif action == "releasegrabber":
-        release()
-    elif action == "dance":
-        dance()
-    elif action == "setting":
-        applySettings(params)
-    
-    return response
+                response = dispatch(stepParts[0], stepParts[1:])
+            except Exception as e:
+                results.append("error:" + str(e))
+                break
+            if collisions:
+                results.append(collisions[0])
+                break
+            results.append(response if response != "" else "ok")
+    finally:
+        notifier = outer
+    return SCRIPT_RESULTS.join(results)
 
 def applySetting(params):
     for p in params:
@@ -80,47 +123,75 @@ def applySetting(params):
                 hub.speaker.volume(int(keyValue[1]))
             except IndexError:
                 pass
+        elif keyValue[0] == "tick":
+            try:
+                setTick(int(keyValue[1]))
+            except IndexError:
+                pass
                 
-def checkSensorsForCollision():
-    if sensor.reflection() <= BLACK_REFLECTION and sensor.color(True) == Color.NONE:
+def notify(message):
+    if notifier is not None:
+        notifier(message)
+    else:
+        stdout.write(message + "\n")
+        stdout.flush()
+
+def setTick(ms):
+    global TICK
+    if ms < 1:
+        raise Framing.CommandError("tick must be at least 1 ms")
+    TICK = ms
+
+def idle():
+    if idleHook is not None:
+        idleHook(TICK)
+    else:
+        wait(TICK)
+
+# The color sensor is read once per control-loop tick, through color(), and
+# every check of the tick works on that reading. The reflection is only
+# needed to tell a black line from the floor, i.e. when no color is seen.
+COLORS = {
+    "white": Color.WHITE,
+    "red": Color.RED,
+    "yellow": Color.YELLOW,
+    "blue": Color.BLUE,
+    "green": Color.GREEN,
+}
+
+def readSensors():
+    return "distance=" + str(eyes.distance()) + "|reflection=" + str(sensor.reflection()) + "|heading=" + str(hub.imu.heading())
+
+def checkSensorsForCollision(color):
+    if color == Color.NONE and sensor.reflection() <= BLACK_REFLECTION:
         drive_base.stop()
         sound_gameover()
-        stdout.write("linedetected")
-        stdout.flush()
+        notify("linedetected")
         return True
     return False
 
-def checkSensors(color):
-    if color == "white" and sensor.color(True) == Color.WHITE:
-        return True
-    elif color == "red" and sensor.color(True) == Color.RED:
-        return True
-    elif color == "yellow" and sensor.color(True) == Color.YELLOW:
-        return True
-    elif color == "blue" and sensor.color(True) == Color.BLUE:
-        return True
-    elif color == "green" and sensor.color(True) == Color.GREEN:
-        return True
-    return False
+def checkSensors(target, color):
+    return COLORS.get(target) == color
 
 
 def drive(steps, ignore="false"):
     drive_base.straight(steps * STEP_UNIT, wait=False)
     while not drive_base.done():
-        wait(10)
+        idle()
         if ignore != "true":
-            if checkSensorsForCollision():
+            if checkSensorsForCollision(sensor.color(True)):
                 return
 
-def driveUntil(color, ignore="false"):
+def driveUntil(target, ignore="false"):
     drive_base.straight(100 * STEP_UNIT, wait=False)
     while not drive_base.done():
-        wait(10)
-        if checkSensors(color):
+        idle()
+        color = sensor.color(True)
+        if checkSensors(target, color):
             drive_base.stop()
             return
         if ignore != "true":
-            if checkSensorsForCollision():
+            if checkSensorsForCollision(color):
                 return
 
 def turn(degrees):
@@ -140,40 +211,83 @@ def grab():
     turn(-15)
     drive_base.straight(-70, wait=True)
 
-def tightenGrabber():
-    claw_motor.run_time(-20, 1500)
+def tightenGrabber(wait=True):
+    claw_motor.run_time(-20, 1500, wait=wait)
 
 def release():
     grabberOpen()
     drive_base.straight(-70, wait=True)
     grabberClose()
 
+# Turns to -r degrees and then to +r in one continuous turn, reading the
+# distance and the heading of the drive base on every tick. Returns the
+# profile as (angle, distance) pairs, angles relative to the start heading.
+def sweep(r):
+    start = drive_base.angle()
+    turn(-r)
+    speed, acceleration, rate, turnAcceleration = drive_base.settings()
+    drive_base.settings(speed, acceleration, SWEEP_RATE, turnAcceleration)
+    profile = []
+    try:
+        drive_base.turn(2 * r, wait=False)
+        while not drive_base.done():
+            profile.append((drive_base.angle() - start, eyes.distance()))
+            idle()
+        profile.append((drive_base.angle() - start, eyes.distance()))
+    finally:
+        drive_base.settings(speed, acceleration, rate, turnAcceleration)
+    return profile
+
+# The nearest object in a profile: its distance and the angle in the middle
+# of the readings around the minimum that are within SWEEP_TOLERANCE of it,
+# as the sensor sees an object over several degrees.
+def nearest(profile):
+    best = 0
+    for i in range(len(profile)):
+        if profile[i][1] < profile[best][1]:
+            best = i
+    distance = profile[best][1]
+    first = best
+    while first > 0 and profile[first - 1][1] <= distance + SWEEP_TOLERANCE:
+        first -= 1
+    last = best
+    while last < len(profile) - 1 and profile[last + 1][1] <= distance + SWEEP_TOLERANCE:
+        last += 1
+    return round((profile[first][0] + profile[last][0]) / 2), distance
+
 def searchObject(r):
     global shortestDistance
     global shortestAngle
-    SEARCH_ANGLE = r
-    found = False
-    for i in range(SEARCH_ANGLE):
-        turn(1)
-        if eyes.distance() < shortestDistance:
-            shortestDistance = eyes.distance()
-            shortestAngle = i
-    turn(-30)
-    for i in range(SEARCH_ANGLE):
-        turn(-1)
-        if eyes.distance() < shortestDistance:
-            shortestDistance = eyes.distance()
-            shortestAngle = i * -1
-    turn(30)
-    if shortestDistance < SEARCH_RANGE:
-        if shortestDistance > SEARCH_CLOSENESS:
-            turn(shortestAngle)
-            drive_base.straight(shortestDistance-SEARCH_CLOSENESS , wait=True)
-            return True
-            #searchObject()
-        else:
-            return True
-    return False    
+    profile = sweep(r)
+    angle, distance = nearest(profile)
+    heading = profile[-1][0]
+    if distance >= shortestDistance:
+        turn(-heading)
+        return False
+    shortestDistance = distance
+    shortestAngle = angle
+    turn(angle - heading)
+    if shortestDistance > SEARCH_CLOSENESS:
+        drive_base.straight(shortestDistance-SEARCH_CLOSENESS , wait=True)
+    return True
+
+# search>[distance]|[angle]: sweeps without moving towards anything.
+# Returns found or notfound, the angle and distance of the nearest object and
+# the profile as angle:distance pairs; each point is the nearest reading of
+# its share of the sweep, so the dip of an object is kept.
+def search(d, r):
+    eyes.lights.on()
+    profile = sweep(r)
+    turn(-profile[-1][0])
+    eyes.lights.off()
+    angle, distance = nearest(profile)
+    size = (len(profile) + PROFILE_POINTS - 1) // PROFILE_POINTS
+    points = []
+    for i in range(0, len(profile), size):
+        a, dist = min(profile[i:i + size], key=lambda point: point[1])
+        points.append(str(round(a)) + ":" + str(dist))
+    result = "found" if distance < d else "notfound"
+    return result + "|angle=" + str(angle) + "|distance=" + str(distance) + "|profile=" + ",".join(points)
 
 def searchAndGrab(d, r):
     global shortestDistance
@@ -230,6 +344,25 @@ def dance():
     drive(-1)
     drive(1)
 
+# The commands the hub understands: action: (handler, argument specs, rest).
+# With rest, arguments beyond the specs are passed to the handler as a list.
+REQUIRED = Framing.REQUIRED
+INT = Framing.INT
+STR = Framing.STR
+COMMANDS = {
+    "drive": (driveCommand, (("target", STR, REQUIRED), ("option", STR, "false"), ("ignore", STR, "false")), False),
+    "turn": (turn, (("degrees", INT, REQUIRED),), False),
+    "display": (display, (("text", STR, REQUIRED),), False),
+    "sensors": (readSensors, (), False),
+    "searchandgrab": (searchAndGrab, (("distance", INT, SEARCH_RANGE), ("angle", INT, SEARCH_ANGLE)), False),
+    "search": (search, (("distance", INT, SEARCH_RANGE), ("angle", INT, SEARCH_ANGLE)), False),
+    "releasegrabber": (release, (), False),
+    "dance": (dance, (), False),
+    "setting": (applySetting, (), True),
+    "script": (runScript, (), True),
+}
+Framing.checkSpecs(COMMANDS)
+
 if __name__ == '__main__':
     #print(sensor.reflection())
     #print(sensor.color(True))